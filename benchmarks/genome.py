@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+Benchmark the sequence stores on a random genome with runs of N and of lowercase bases.
+
+The in-memory Genome is compared with keeping each contig as a string,
+and extraction of many windows at once with fetching the windows one by one,
+for both the packed Genome and the memory-mapped Fasta.
+All stores are checked to return the same windows.
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from srufinder.sequences import Fasta, Genome, write_fasta
+
+def random_genome(size, contigs, seed=1):
+    '''
+    Random contigs with about 1% in runs of N and 10% in runs of lowercase
+    '''
+
+    rng = np.random.default_rng(seed)
+    records = []
+    for i, n in enumerate(np.diff(np.linspace(0, size, contigs+1).astype(int))):
+        seq = np.frombuffer(b'ACGT', dtype=np.uint8)[rng.integers(0, 4, n)].copy()
+        for start in rng.integers(0, n, n//10000):
+            seq[start:start+100] = ord('N')
+        for start in rng.integers(0, n, n//10000):
+            seq[start:start+1000] |= 32
+        records.append(('contig_{} random'.format(i), seq.tobytes().decode()))
+
+    return records
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the sequence stores')
+    ap.add_argument('--size', help='Genome size in Mb [%(default)s].', default=50, type=float)
+    ap.add_argument('--contigs', help='Number of contigs [%(default)s].', default=50, type=int)
+    ap.add_argument('--windows', help='Windows extracted [%(default)s].', default='1000,10000,100000', type=str)
+    ap.add_argument('--length', help='Window length [%(default)s].', default=100, type=int)
+    args = ap.parse_args()
+
+    records = random_genome(int(args.size*1e6), args.contigs)
+    strings = {x.split()[0]: y for x, y in records}
+
+    t0 = time.perf_counter()
+    genome = Genome(records)
+    t_pack = time.perf_counter() - t0
+    packed = genome.packed.nbytes + sum(x.nbytes for x in genome.lower + genome.other)
+    unpacked = sum(sys.getsizeof(x) for x in strings.values())
+    print('Strings (MB)\tGenome (MB)\tPacking (s)')
+    print('{:.1f}\t{:.1f}\t{:.2f}\n'.format(unpacked/1e6, packed/1e6, t_pack))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'genome.fna'), 'w') as out_file:
+            for header, seq in records:
+                write_fasta(out_file, header, seq)
+        fasta = Fasta(os.path.join(tmp, 'genome.fna'))
+
+        rng = np.random.default_rng(2)
+        names = np.array(list(strings))
+        print('Windows\tGenome one by one (s)\tGenome at once (s)\tFasta one by one (s)\tFasta at once (s)\tIdentical')
+        for n in [int(x) for x in args.windows.split(',')]:
+            accs = names[rng.integers(0, len(names), n)]
+            starts = rng.integers(-args.length, int(args.size*1e6/args.contigs), n)
+            ends = starts + args.length
+
+            times = []
+            results = []
+            for store in (genome, fasta):
+                t0 = time.perf_counter()
+                results.append([store.fetch(x, y, z) for x, y, z in zip(accs, starts, ends)])
+                times.append(time.perf_counter() - t0)
+                t0 = time.perf_counter()
+                results.append(store.extract(accs, starts, ends))
+                times.append(time.perf_counter() - t0)
+
+            expected = [strings[x][max(y, 0):max(z, 0)] for x, y, z in zip(accs, starts, ends)]
+            same = all(x == expected for x in results)
+            print('\t'.join([str(n)] + ['{:.3f}'.format(x) for x in times] + [str(same)]))
+
+if __name__ == '__main__':
+    main()
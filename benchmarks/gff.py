@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+Compare the streaming prodigal GFF parser with the previous
+pandas parser (regex separator and python engine) on synthetic GFFs
+'''
+
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from srufinder.prodigal import read_gff
+
+def synthetic_gff(path, n, contigs, seed=1):
+    '''
+    Write a prodigal-like GFF with n genes spread over contigs
+    '''
+
+    rng = np.random.default_rng(seed)
+    per_contig = np.bincount(rng.integers(0, contigs, n), minlength=contigs)
+    with open(path, 'w') as f:
+        f.write('##gff-version  3\n')
+        for c, k in enumerate(per_contig):
+            f.write('# Sequence Data: seqnum={};seqlen={};seqhdr="contig_{}"\n'.format(c+1, k*1000+1000, c))
+            f.write('# Model Data: version=Prodigal.v2.6.3;run_type=Single;model="Ab initio";gc_cont=50.00;transl_table=11;uses_sd=1\n')
+            starts = np.sort(rng.integers(1, k*1000+1, k))
+            confs = np.round(rng.uniform(50, 100, k), 2)
+            for i, (s, conf) in enumerate(zip(starts, confs)):
+                f.write('contig_{}\tProdigal_v2.6.3\tCDS\t{}\t{}\t{:.1f}\t{}\t0\t'
+                        'ID={}_{};partial=00;start_type=ATG;rbs_motif=AGGAG;rbs_spacer=5-10bp;gc_cont=0.512;'
+                        'conf={:.2f};score=50.32;cscore=38.02;sscore=12.30;rscore=8.31;uscore=1.34;tscore=3.30;\n'.format(
+                            c, s, s+299, conf, '+-'[i % 2], c+1, i+1, conf))
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark prodigal GFF parsing')
+    ap.add_argument('--sizes', help='Number of genes [%(default)s].', default='10000,100000,1000000', type=str)
+    ap.add_argument('--contigs', help='Number of contigs [%(default)s].', default=1000, type=int)
+    ap.add_argument('--orf', help='ORF confidence threshold [%(default)s].', default=80, type=int)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print('Genes\tKept\tStreaming (s)\tPandas (s)\tIdentical')
+        for n in [int(x) for x in args.sizes.split(',')]:
+            path = tmp+'/prodigal.gff'
+            synthetic_gff(path, n, args.contigs)
+
+            t0 = time.perf_counter()
+            with open(path) as handle:
+                new, _ = read_gff(handle, args.orf)
+            t_new = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            old = pd.read_csv(path, sep='\t|;[a-z,A-Z,_]*=', comment="#", engine='python', header=None)
+            old = old[old.iloc[:,14] >= args.orf]
+            t_old = time.perf_counter() - t0
+
+            same = (list(old.iloc[:,0]) == list(new['Acc']) and
+                    np.array_equal(old.iloc[:,3].values, new['Start'].values) and
+                    np.array_equal(old.iloc[:,4].values, new['End'].values))
+
+            print('{}\t{}\t{:.2f}\t{:.2f}\t{}'.format(n, len(new), t_new, t_old, same))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+'''
+Compare the built-in k-mer matcher with blastn on synthetic genomes
+with repeats from the database planted with random mismatches.
+
+Recall is the fraction of planted repeats overlapped by a hit passing the
+identity and coverage cutoffs, and precision the fraction of such hits
+overlapping a planted repeat. When blastn is in PATH, the recall and
+precision of the k-mer hits against the BLAST hits are reported as well.
+'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from srufinder import kmer
+from srufinder.sequences import Fasta, write_fasta
+
+def plant(repeatdb, path, size, n, seed=1):
+    '''
+    Write a random genome with n repeats planted, and return the planted positions
+    '''
+
+    rng = np.random.default_rng(seed)
+    fasta = Fasta(repeatdb)
+    names = fasta.names()
+    genome = rng.choice(list('ACGT'), size)
+    truth = []
+    for pos in np.sort(rng.choice(np.arange(size - 100), n, replace=False)):
+        name = names[rng.integers(len(names))]
+        rep = np.array(list(fasta[name]))
+        # Up to 10% mismatches
+        for i in rng.choice(len(rep), rng.integers(0, len(rep)//10 + 1), replace=False):
+            rep[i] = rng.choice([x for x in 'ACGT' if x != rep[i]])
+        if rng.random() < 0.5:
+            rep = np.array(list(''.join(rep)[::-1].translate(str.maketrans('ACGTN', 'TGCAN'))))
+        if len(truth) == 0 or pos > truth[-1][2]:
+            genome[pos:pos+len(rep)] = rep
+            truth.append((name, pos+1, pos+len(rep)))
+
+    with open(path, 'w') as handle:
+        write_fasta(handle, 'genome', ''.join(genome))
+
+    return pd.DataFrame(truth, columns=['Repeat', 'Min', 'Max'])
+
+def passing(hits, lengths, identity, coverage):
+    '''
+    Hits passing identity and coverage cutoffs
+    '''
+
+    hits = hits.merge(lengths, left_on='Repeat', right_index=True)
+    hits = hits[(hits['Identity'] >= identity) & ((hits['Alignment']-hits['Gaps'])/hits['Repeat_len']*100 >= coverage)]
+    return hits.assign(Min=hits[['Acc_start','Acc_end']].min(axis=1), Max=hits[['Acc_start','Acc_end']].max(axis=1))
+
+def overlapping(a, b):
+    '''
+    For each interval in a, whether it overlaps any interval in b
+    '''
+
+    b = b.sort_values('Min')
+    ends = np.maximum.accumulate(b['Max'].values)
+    ind = np.searchsorted(b['Min'].values, a['Max'].values, 'right') - 1
+    return (ind >= 0) & (ends[np.maximum(ind, 0)] >= a['Min'].values)
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the k-mer matcher against blastn')
+    ap.add_argument('--db', help='Path to database [%(default)s].', default=os.environ.get('SRUFINDER_DB', 'data'), type=str)
+    ap.add_argument('--sizes', help='Genome sizes [%(default)s].', default='1000000,5000000', type=str)
+    ap.add_argument('--density', help='Planted repeats per Mb [%(default)s].', default=200, type=int)
+    ap.add_argument('--kmer_size', help='Seed size for the k-mer matcher [%(default)s].', default=10, type=int)
+    ap.add_argument('--word_size', help='Word size for BLASTN [%(default)s].', default=6, type=int)
+    ap.add_argument('--identity', help='Identity cutoff [%(default)s].', default=90, type=float)
+    ap.add_argument('--coverage', help='Coverage cutoff [%(default)s].', default=90, type=float)
+    ap.add_argument('-t', '--threads', help='Threads for BLAST [%(default)s].', default=4, type=int)
+    args = ap.parse_args()
+
+    repeatdb = os.path.join(args.db, 'repeats.fa')
+    fasta = Fasta(repeatdb)
+    lengths = pd.DataFrame({'Repeat_len': [fasta.length(x) for x in fasta.names()]}, index=fasta.names())
+    blast = shutil.which('blastn') is not None and shutil.which('makeblastdb') is not None
+
+    t0 = time.perf_counter()
+    index = kmer.load_index(repeatdb, args.kmer_size)
+    print('Index built in {:.2f} s'.format(time.perf_counter() - t0))
+
+    print('Size\tMatcher\tTime (s)\tRecall\tPrecision\tRecall vs BLAST\tPrecision vs BLAST')
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [int(x) for x in args.sizes.split(',')]:
+            truth = plant(repeatdb, tmp+'/genome.fna', size, size*args.density//1000000)
+            results = {}
+
+            t0 = time.perf_counter()
+            results['kmer'] = passing(index.search(Fasta(tmp+'/genome.fna')), lengths, args.identity, args.coverage)
+            times = {'kmer': time.perf_counter() - t0}
+
+            if blast:
+                t0 = time.perf_counter()
+                subprocess.run(['makeblastdb', '-dbtype', 'nucl', '-in', tmp+'/genome.fna', '-out', tmp+'/genome'], stdout=subprocess.DEVNULL)
+                subprocess.run(['blastn', '-task', 'blastn-short', '-word_size', str(args.word_size),
+                                '-query', repeatdb, '-db', tmp+'/genome', '-outfmt', '6',
+                                '-out', tmp+'/blast.tab', '-num_threads', str(args.threads)])
+                times['blast'] = time.perf_counter() - t0
+                results['blast'] = passing(pd.read_csv(tmp+'/blast.tab', sep='\t', header=None, names=kmer.BLAST_COLUMNS),
+                                           lengths, args.identity, args.coverage)
+
+            for matcher, hits in results.items():
+                recall = overlapping(truth, hits).mean() if len(hits) else 0
+                precision = overlapping(hits, truth).mean() if len(hits) else float('nan')
+                vs = ('NA', 'NA')
+                if matcher == 'kmer' and blast and len(hits) and len(results['blast']):
+                    vs = ('{:.3f}'.format(overlapping(results['blast'], hits).mean()),
+                          '{:.3f}'.format(overlapping(hits, results['blast']).mean()))
+                print('{}\t{}\t{:.2f}\t{:.3f}\t{:.3f}\t{}\t{}'.format(size, matcher, times[matcher], recall, precision, *vs))
+
+if __name__ == '__main__':
+    main()
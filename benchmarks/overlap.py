@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+'''
+Benchmark Cluster.remove_overlap on synthetic hit tables.
+
+The quadratic reference (checking every hit against all kept hits) is only
+timed on the smaller tables, where it is also used to check that the kept
+set is unchanged.
+'''
+
+import argparse
+import time
+import types
+
+import numpy as np
+import pandas as pd
+
+from srufinder.cluster import Cluster
+
+def synthetic_hits(n, contigs, seed=1):
+    '''
+    Random hits of 20-50 bp spread over contigs of a size giving dense overlaps
+    '''
+
+    rng = np.random.default_rng(seed)
+    length = rng.integers(20, 51, n)
+    start = rng.integers(1, max(n, 1000)*10, n)
+    end = start + length - 1
+    strand = rng.random(n) < 0.5
+    df = pd.DataFrame({'Acc': ['contig_{}'.format(x) for x in rng.integers(0, contigs, n)],
+                       'Acc_start': np.where(strand, start, end),
+                       'Acc_end': np.where(strand, end, start),
+                       'Score': np.round(rng.uniform(20, 70, n), 1),
+                       'Coverage': np.round(rng.uniform(50, 100, n), 1)})
+    df['Min'] = df[['Acc_start','Acc_end']].min(axis=1)
+    df['Max'] = df[['Acc_start','Acc_end']].max(axis=1)
+    return df
+
+def quadratic(df):
+    '''
+    The original traversal comparing each hit with all kept hits
+    '''
+
+    df = df.sort_values(['Acc', 'Score', 'Coverage'], ascending=False)
+    keep_lst = []
+    for i in set(df['Acc']):
+        tmp = df[df['Acc'] == i]
+        tmp = tmp.drop_duplicates('Min')
+        tmp = tmp.drop_duplicates('Max')
+        tmp = tmp.drop_duplicates('Acc_start')
+        tmp = tmp.drop_duplicates('Acc_end')
+        keep = []
+        matches_all = []
+        for ind, k in enumerate(tmp[['Min','Max']].values):
+            if not any([k[0] <= y[1] and y[0] <= k[1] for y in matches_all]):
+                keep.append(ind)
+                matches_all.append(k)
+        keep_lst.append(tmp.iloc[keep,:])
+    return pd.concat(keep_lst)
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark overlap removal')
+    ap.add_argument('--sizes', help='Table sizes [%(default)s].', default='10000,100000,1000000', type=str)
+    ap.add_argument('--contigs', help='Number of contigs [%(default)s].', default=10, type=int)
+    ap.add_argument('--max_quadratic', help='Largest table to run the quadratic reference on [%(default)s].', default=20000, type=int)
+    args = ap.parse_args()
+
+    # Overlaps are removed per contig and need no settings
+    cluster = Cluster(types.SimpleNamespace())
+
+    print('Rows\tKept\tSorted (s)\tQuadratic (s)\tIdentical')
+    for n in [int(x) for x in args.sizes.split(',')]:
+        df = synthetic_hits(n, args.contigs)
+
+        t0 = time.perf_counter()
+        new = pd.concat([cluster.remove_overlap(tmp) for _, tmp in df.groupby('Acc')])
+        t_new = time.perf_counter() - t0
+
+        t_old = same = 'NA'
+        if n <= args.max_quadratic:
+            t0 = time.perf_counter()
+            old = quadratic(df)
+            t_old = '{:.2f}'.format(time.perf_counter() - t0)
+            same = set(old.index) == set(new.index)
+
+        print('{}\t{}\t{:.2f}\t{}\t{}'.format(n, len(new), t_new, t_old, same))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+'''
+Time each stage of the pipeline on synthetic genomes of increasing size,
+and check the results against the planted truth.
+
+Genomes are generated with synthetic.py and kept in the work directory,
+so later runs on the same tiers only time the pipeline.
+Peak RSS is the maximum of this process and of the largest child process
+(prodigal, makeblastdb, blastn) up to the end of each stage.
+
+Recall is the fraction of planted features of each class found as the
+expected kind: SRUs for sru, arrays for mini, long, and partial, where
+partial arrays also have to cover the truncated repeat. For repeats planted
+inside genes the fraction found as SRUs or arrays is reported, which should
+be low unless --in_orf is used. Any extra arguments are passed on to SRUFinder.
+'''
+
+import argparse
+import os
+import resource
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from srufinder.arguments import add_options
+from srufinder.controller import Controller
+from srufinder.prodigal import Prodigal
+from srufinder.blast import Blast
+from srufinder.cluster import Cluster
+
+from synthetic import CLASSES, Generator
+
+STAGES = ('prodigal', 'blast', 'cluster', 'spacer')
+
+def peak_rss():
+    '''
+    Peak RSS in MB of this process and of the largest finished child
+    '''
+
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/1024
+
+def run_stages(genome, out, extra):
+    '''
+    Run the pipeline stage by stage and return the time and peak RSS after each stage
+    '''
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('input')
+    ap.add_argument('output')
+    add_options(ap)
+    args = ap.parse_args([genome, out] + extra)
+
+    master = Controller(args)
+    blast = Blast(master)
+    steps = {'prodigal': Prodigal(master).run,
+             'blast': blast.run,
+             'cluster': Cluster(master).run,
+             'spacer': blast.run_spacer}
+
+    stats = {}
+    for stage in STAGES:
+        t0 = time.perf_counter()
+        steps[stage]()
+        stats[stage] = (time.perf_counter() - t0, peak_rss())
+
+    return stats
+
+def overlapping(truth, found, cover=False):
+    '''
+    For each planted feature, whether a found feature on the same contig overlaps it,
+    or covers it if cover is True
+    '''
+
+    hit = np.zeros(len(truth), dtype=bool)
+    if found is None:
+        return hit
+
+    for acc, ind in truth.groupby('Acc').indices.items():
+        sub = found[found['Acc'] == acc]
+        if len(sub) == 0:
+            continue
+        t = truth.iloc[ind]
+        start = sub['Start'].values[None, :]
+        end = sub['End'].values[None, :]
+        if cover:
+            ok = (start <= t['Start'].values[:, None]) & (end >= t['End'].values[:, None])
+        else:
+            ok = (start <= t['End'].values[:, None]) & (end >= t['Start'].values[:, None])
+        hit[ind] = ok.any(axis=1)
+
+    return hit
+
+def recall(truth, out):
+    '''
+    Fraction of planted features of each class which were found
+    '''
+
+    srus = pd.read_csv(out+'SRUs.tab', sep='\t') if os.path.isfile(out+'SRUs.tab') else None
+    arrays = pd.read_csv(out+'arrays.tab', sep='\t') if os.path.isfile(out+'arrays.tab') else None
+
+    res = {}
+    for cls in CLASSES:
+        t = truth[truth['Class'] == cls].reset_index(drop=True)
+        if len(t) == 0:
+            res[cls] = float('nan')
+        elif cls == 'sru':
+            res[cls] = overlapping(t, srus).mean()
+        elif cls == 'partial':
+            res[cls] = overlapping(t, arrays, cover=True).mean()
+        elif cls == 'orf':
+            res[cls] = (overlapping(t, srus) | overlapping(t, arrays)).mean()
+        else:
+            res[cls] = overlapping(t, arrays).mean()
+
+    return res
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic genomes')
+    ap.add_argument('--db', help='Path to database [%(default)s].', default=os.environ.get('SRUFINDER_DB', 'data'), type=str)
+    ap.add_argument('--sizes', help='Genome sizes in Mb [%(default)s].', default='1,10,100', type=str)
+    ap.add_argument('--contigs', help='Contigs per Mb [%(default)s].', default=5, type=float)
+    ap.add_argument('--density', help='Planted features of each class per Mb [%(default)s].', default=20, type=int)
+    ap.add_argument('--seed', help='Random seed [%(default)s].', default=1, type=int)
+    ap.add_argument('--workdir', help='Directory for genomes and outputs [%(default)s].', default='srufinder_bench', type=str)
+    args, extra = ap.parse_known_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    workdir = os.path.join(args.workdir, '')
+
+    print('\t'.join(['Size (Mb)', 'Contigs'] +
+                    ['{} (s)'.format(x) for x in STAGES] +
+                    ['Peak RSS (MB)'] +
+                    ['Recall {}'.format(x) for x in CLASSES]))
+
+    for size in [float(x) for x in args.sizes.split(',')]:
+        contigs = max(int(size*args.contigs), 1)
+        genome = workdir+'genome_{:g}Mb_{}.fna'.format(size, contigs)
+        truth_file = os.path.splitext(genome)[0]+'.truth.tab'
+
+        if not os.path.isfile(truth_file):
+            generator = Generator(os.path.join(args.db, 'repeats.fa'), args.density, args.seed)
+            generator.write(genome, int(size*1e6), contigs).to_csv(truth_file, index=False, sep='\t')
+        truth = pd.read_csv(truth_file, sep='\t')
+
+        out = workdir+'out_{:g}Mb/'.format(size)
+        if os.path.isdir(out):
+            shutil.rmtree(out)
+
+        stats = run_stages(genome, out, ['--db', args.db] + extra)
+        res = recall(truth, out)
+
+        times = ['{:.2f}'.format(stats[x][0]) if x in stats else 'NA' for x in STAGES]
+        rss = max(x[1] for x in stats.values())
+        print('\t'.join(['{:g}'.format(size), str(contigs)] + times + ['{:.0f}'.format(rss)] +
+                        ['{:.3f}'.format(res[x]) for x in CLASSES]), flush=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+'''
+Generate synthetic genomes with known SRUs and CRISPR arrays.
+
+Contigs are built from stop-free genes separated by random intergenic
+regions, and repeats from the database are planted as:
+sru      a single repeat in an intergenic region
+mini     an array of 2-3 repeats
+long     an array of 10-30 repeats
+partial  an array of 3-5 repeats where the last repeat is truncated
+orf      a single repeat inside a gene, in frame
+
+The planted features are written to a truth table with 1-based coordinates.
+'''
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from srufinder.sequences import Fasta, write_fasta
+
+CLASSES = ('sru', 'mini', 'long', 'partial', 'orf')
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+STOPS = ('TAA', 'TAG', 'TGA')
+CODONS = [a+b+c for a in 'ACGT' for b in 'ACGT' for c in 'ACGT' if a+b+c not in STOPS]
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+class Generator(object):
+    '''
+    Build contigs of genes and intergenic regions with planted repeats
+    '''
+
+    def __init__(self, repeatdb, density, seed=1):
+
+        self.rng = np.random.default_rng(seed)
+        fasta = Fasta(repeatdb)
+        self.repeats = [(x, fasta[x].upper()) for x in fasta.names()]
+        self.density = density
+
+    def random(self, n):
+        return BASES[self.rng.integers(0, 4, n)].tobytes().decode()
+
+    def revcomp(self, seq):
+        return seq.translate(COMPLEMENT)[::-1]
+
+    def repeat(self):
+        return self.repeats[self.rng.integers(len(self.repeats))]
+
+    def gene(self, n_codons):
+        return 'ATG' + ''.join(self.rng.choice(CODONS, n_codons)) + 'TAA'
+
+    def orf_repeat(self):
+        '''
+        A gene with a repeat inside, in a frame without stop codons
+        '''
+
+        while True:
+            name, rep = self.repeat()
+            for frame in range(3):
+                head = 'ATG' + ''.join(self.rng.choice(CODONS, self.rng.integers(100, 300))) + self.random(frame)
+                body = head + rep
+                tail = self.random((3 - len(body) % 3) % 3)
+                body += tail
+                codons = [body[i:i+3] for i in range(0, len(body), 3)]
+                if not any(x in STOPS for x in codons[1:]):
+                    seq = body + ''.join(self.rng.choice(CODONS, self.rng.integers(100, 300))) + 'TAA'
+                    return name, seq, len(head), len(rep)
+
+    def array(self, rep, copies, truncate=None):
+        '''
+        Copies of a repeat separated by random spacers, optionally with the last copy truncated
+        '''
+
+        parts = []
+        for i in range(copies):
+            if i > 0:
+                parts.append(self.random(self.rng.integers(30, 41)))
+            if i == copies-1 and truncate is not None:
+                parts.append(rep[:truncate])
+            else:
+                parts.append(rep)
+
+        return ''.join(parts)
+
+    def feature(self, cls):
+        '''
+        Get the sequence of a feature, the offset and length of the planted part,
+        the repeat, and the number of copies
+        '''
+
+        if cls == 'orf':
+            name, seq, offset, length = self.orf_repeat()
+            return seq, offset, length, name, 1
+
+        name, rep = self.repeat()
+        if cls == 'sru':
+            copies, truncate = 1, None
+        elif cls == 'mini':
+            copies, truncate = self.rng.integers(2, 4), None
+        elif cls == 'long':
+            copies, truncate = self.rng.integers(10, 31), None
+        else:
+            copies, truncate = self.rng.integers(3, 6), int(len(rep)*self.rng.uniform(0.6, 0.8))
+        seq = self.array(rep, copies, truncate)
+
+        return seq, 0, len(seq), name, copies
+
+    def contig(self, name, length):
+        '''
+        Build a contig of about the given length and return the sequence and its planted features
+        '''
+
+        rate = self.density*len(CLASSES)/1e6
+        parts = []
+        truth = []
+        pos = 0
+        while pos < length:
+            parts.append(self.random(self.rng.integers(100, 400)))
+            pos += len(parts[-1])
+
+            # A feature instead of a gene, with genes and intergenic regions of about 1900 bp
+            if self.rng.random() < rate*1900:
+                cls = CLASSES[self.rng.integers(len(CLASSES))]
+                seq, offset, size, rep, copies = self.feature(cls)
+                if cls != 'orf':
+                    seq = self.random(200) + seq + self.random(200)
+                    offset += 200
+                if self.rng.random() < 0.5:
+                    seq = self.revcomp(seq)
+                    offset = len(seq) - offset - size
+                truth.append((name, pos+offset+1, pos+offset+size, cls, rep, copies))
+            else:
+                seq = self.gene(self.rng.integers(100, 1000))
+                if self.rng.random() < 0.5:
+                    seq = self.revcomp(seq)
+
+            parts.append(seq)
+            pos += len(seq)
+
+        return ''.join(parts), truth
+
+    def write(self, path, size, contigs):
+        '''
+        Write a genome of about size bp in a number of contigs, and return the truth table
+        '''
+
+        lengths = self.rng.dirichlet(np.full(contigs, 5.0))*size
+        truth = []
+        with open(path, 'w') as handle:
+            for i, length in enumerate(lengths):
+                name = 'contig_{}'.format(i+1)
+                seq, planted = self.contig(name, max(int(length), 1000))
+                write_fasta(handle, name, seq)
+                truth += planted
+
+        return pd.DataFrame(truth, columns=['Acc', 'Start', 'End', 'Class', 'Repeat', 'Copies'])
+
+def main():
+    ap = argparse.ArgumentParser(description='Write a synthetic genome with planted SRUs and CRISPR arrays')
+    ap.add_argument('output', help='Output fasta. The truth table is written next to it with extension .truth.tab', type=str)
+    ap.add_argument('--db', help='Path to database [%(default)s].', default=os.environ.get('SRUFINDER_DB', 'data'), type=str)
+    ap.add_argument('--size', help='Genome size in bp [%(default)s].', default=1000000, type=int)
+    ap.add_argument('--contigs', help='Number of contigs [%(default)s].', default=1, type=int)
+    ap.add_argument('--density', help='Planted features of each class per Mb [%(default)s].', default=20, type=int)
+    ap.add_argument('--seed', help='Random seed [%(default)s].', default=1, type=int)
+    args = ap.parse_args()
+
+    generator = Generator(os.path.join(args.db, 'repeats.fa'), args.density, args.seed)
+    truth = generator.write(args.output, args.size, args.contigs)
+    truth.to_csv(os.path.splitext(args.output)[0]+'.truth.tab', index=False, sep='\t')
+
+    print(truth.groupby('Class').size().to_string())
+
+if __name__ == '__main__':
+    main()
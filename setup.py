@@ -24,5 +24,5 @@ setuptools.setup(
     python_requires='>=3.8',
     install_requires=[
         "setuptools"],
-    scripts=['bin/srufinder']
+    scripts=['bin/srufinder', 'bin/srufinder-batch', 'bin/srufinder-server', 'bin/srufinder-compact', 'bin/srufinder-sweep', 'bin/srufinder-shard']
 )
@@ -1 +1,4 @@
 name = "srufinder"
+
+from srufinder.api import find, Result
+from srufinder.errors import SRUFinderError
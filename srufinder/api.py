@@ -0,0 +1,90 @@
+import os
+import argparse
+import functools
+import collections
+
+from srufinder.arguments import add_options
+from srufinder.controller import Controller, read_len
+from srufinder.prodigal import Prodigal
+from srufinder.blast import Blast
+from srufinder.cluster import Cluster
+from srufinder.sequences import Fasta, Genome
+from srufinder.errors import SRUFinderError
+
+Result = collections.namedtuple('Result', ['srus', 'arrays', 'spacers'])
+
+# Options of the command line which only apply to runs with an output directory
+FILE_OPTIONS = ('resume', 'stream_mb', 'selfmatch', 'profile', 'cprofile', 'log_lvl', 'orf_split', 'training', 'shard')
+
+@functools.lru_cache(maxsize=4)
+def repeat_lengths(repeatdb):
+    '''
+    Read the repeat lengths once per process
+    '''
+
+    return read_len(repeatdb)
+
+def get_args(params):
+    '''
+    Get the command line defaults updated with the given parameters.
+    The k-mer matcher and a single thread are the defaults, such that all steps but prodigal run in-process
+    '''
+
+    ap = argparse.ArgumentParser()
+    add_options(ap)
+    args = ap.parse_args([])
+    args.input = None
+    args.output = None
+    args.matcher = 'kmer'
+    args.threads = 1
+
+    for k, v in params.items():
+        if not hasattr(args, k) or k in FILE_OPTIONS:
+            raise TypeError("find() got an unexpected keyword argument '{}'".format(k))
+        setattr(args, k, v)
+
+    return args
+
+def get_sequences(sequences):
+    '''
+    Get the sequences from a fasta path, a dict of header to sequence,
+    or an iterable of (header, sequence) pairs or Biopython SeqRecords
+    '''
+
+    try:
+        if isinstance(sequences, (str, os.PathLike)):
+            if not os.path.isfile(sequences):
+                raise SRUFinderError('Could not find input file')
+            return Fasta(sequences)
+        if isinstance(sequences, dict):
+            return Genome(sequences.items())
+        return Genome((x.description or x.id, str(x.seq)) if hasattr(x, 'seq') else x for x in sequences)
+    except ValueError as e:
+        if str(e).startswith('Duplicate'):
+            raise SRUFinderError('Duplicate fasta headers detected!\nPlease ensure input has unique headers without spaces.')
+        raise SRUFinderError('Input is in bad format')
+
+def find(sequences, **params):
+    '''
+    Find SRUs and CRISPR arrays in sequences, without an output directory.
+    Parameters are the long command line options, e.g. find(seqs, prodigal='meta', identity=95).
+    Return the SRUs, arrays, and spacers as dataframes, which are empty if nothing is found.
+    Bad input or a failing prodigal raises SRUFinderError
+    '''
+
+    args = get_args(params)
+    sequences = get_sequences(sequences)
+
+    db = args.db if args.db != '' else os.environ.get('SRUFINDER_DB', '')
+    if db == '':
+        raise SRUFinderError('Could not find database directory')
+    args.db = db
+
+    master = Controller(args, repeat_lengths(os.path.join(db, 'repeats.fa')), sequences=sequences)
+
+    Prodigal(master).run()
+    Blast(master).run()
+    cluster = Cluster(master)
+    cluster.run()
+
+    return Result(cluster.df_sru, cluster.df_arrays, cluster.df_spacers)
@@ -0,0 +1,49 @@
+import pkg_resources
+
+def version():
+    '''
+    Return the installed SRUFinder version
+    '''
+
+    return pkg_resources.require("srufinder")[0].version
+
+def add_options(ap):
+    '''
+    Add the optional, data, and threshold arguments shared by all entry points
+    '''
+
+    # Optional
+    ap.add_argument('-t', '--threads', help='Number of parallel processes [%(default)s].', default=4, type=int)
+    ap.add_argument('--prodigal', help='Which mode to run prodigal in [%(default)s].', default='single', type=str, choices=['single','meta'])
+    ap.add_argument('--log_lvl', help='Logging level [%(default)s].', default='INFO', type=str, choices=['DEBUG','INFO','WARNING','ERROR'])
+    ap.add_argument('--selfmatch', help='Do self-targeting analysis, i.e. BLAST spacers against the input', action='store_true')
+    ap.add_argument('--matcher', help='How to match repeats against the input. blast runs blastn, kmer uses the built-in ungapped k-mer seed-and-extend matcher [%(default)s].', default='blast', type=str, choices=['blast','kmer'])
+    ap.add_argument('--resume', help='Resume a run in an existing output directory, reusing the output of all steps whose inputs and arguments are unchanged. Intermediate files are kept for later runs', action='store_true')
+    ap.add_argument('--stream_mb', help='Process the input in batches of contigs of at most this many Mb, appending results as each batch finishes, such that memory use does not grow with the size of the input. 0 processes all at once [%(default)s].', default=0, type=float)
+    ap.add_argument('--profile', help='Write the wall time, CPU time, peak memory, and row counts of each step to timings.json', action='store_true')
+    ap.add_argument('--cprofile', help='As --profile, and also write cProfile statistics of each step to profile_<step>.prof', action='store_true')
+    ap.add_argument('--training', help='Pretrained prodigal model to use in single mode, e.g. from srufinder-shard split', default=None, type=str)
+    ap.add_argument('--shard', help='Run on a shard of an input split with srufinder-shard split. The input masked by arrays is kept, and self-matching is left to srufinder-shard merge', action='store_true')
+    ap.add_argument('--no_compact', help='Search all repeats of the database, also if it has been compacted with srufinder-compact', action='store_true')
+    ap.add_argument('--in_orf', help='Reverse the search to only search inside ORFs, as a means to distinguish false from true SRUs', action='store_true')
+    ap.add_argument('--orf_split', help='Search the input without masking, and split matches in intergenic and inside ORFs. Intergenic results are written as usual, and results inside ORFs to files ending with _in_orf, with the coordinates of an overlapping ORF. Overrides --in_orf', action='store_true')
+
+    # Data
+    apd = ap.add_argument_group('data arguments')
+    apd.add_argument('--db', help='Path to database.', default='', type=str)
+
+    # Thresholds
+    apt = ap.add_argument_group('threshold arguments')
+    apt.add_argument('--orf', help='ORF confidence threshold [%(default)s].', default=80, type=int)
+    apt.add_argument('--word_size', help='Word size for BLASTN [%(default)s].', default=6, type=int)
+    apt.add_argument('--kmer_size', help='Seed size for the k-mer matcher [%(default)s].', default=10, type=int)
+    apt.add_argument('--identity', help='Identity cutoff for considering BLAST matches [%(default)s].', default=90, type=float)
+    apt.add_argument('--coverage', help='Coverage cutoff for splitting matches in complete and partial [%(default)s].', default=90, type=float)
+    apt.add_argument('--score', help='BLAST score cutoff for discerning false from putative SRUs. This has been set empirically by comparing scores of intergenic (putative) SRUs and SRUs inside ORFs (false) [%(default)s].', default=41.1, type=float)
+    apt.add_argument('--coverage_part', help='Coverage cutoff for partial matches [%(default)s].', default=50, type=float)
+    apt.add_argument('--max_dist', help='Maximum distance between matches to be part of same array [%(default)s].', default=100, type=int)
+    apt.add_argument('--flank', help='bp to extract of the flanking regions [%(default)s].', default=100, type=int)
+    apt.add_argument('--spacer_identity', help='Identity cutoff for considering BLAST matches for spacers [%(default)s].', default=90, type=float)
+    apt.add_argument('--spacer_coverage', help='Coverage cutoff for considering BLAST matches for spacers [%(default)s].', default=90, type=float)
+
+    return ap
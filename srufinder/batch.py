@@ -0,0 +1,168 @@
+import os
+import logging
+import copy
+import traceback
+import multiprocessing
+
+from srufinder.controller import read_len
+from srufinder.errors import SRUFinderError
+from srufinder import workflow
+from srufinder import repeats
+
+FASTA_EXT = ('.fa', '.fna', '.fasta', '.fas', '.ffn')
+FASTA_EXT += tuple(x+'.gz' for x in FASTA_EXT)
+
+# Repeat length table shared by the workers of a batch
+_len_df = None
+
+def _init_worker(len_df, repeatdb):
+    '''
+    Store the shared repeat length table in the worker process,
+    and load the repeat table once for all genomes of the worker
+    '''
+
+    global _len_df
+    _len_df = len_df
+    repeats.load(os.path.dirname(repeatdb))
+
+def _run_genome(job):
+    '''
+    Run the workflow on a single genome and report how it went, with the error if any.
+    Errors are caught such that one bad genome does not stop the batch
+    '''
+
+    name, args = job
+
+    try:
+        workflow.run(args, _len_df)
+        return (name, ('done', ''))
+    except SRUFinderError as e:
+        logging.error('Genome {} stopped: {}'.format(name, e))
+        return (name, ('stopped', str(e)))
+    except Exception as e:
+        logging.error('Genome {} failed:\n{}'.format(name, traceback.format_exc()))
+        return (name, ('failed', '{}: {}'.format(type(e).__name__, e)))
+
+def genome_name(fn):
+    '''
+    Name a genome by its file name without fasta and gzip extensions
+    '''
+
+    if fn.endswith('.gz'):
+        fn = fn[:-3]
+    return os.path.splitext(fn)[0]
+
+class Batch(object):
+
+    def __init__(self, args):
+        '''
+        Initialize batch by:
+        Starting the logger
+        Checking database, input, and output
+        Loading the repeat lengths once for all genomes
+        '''
+
+        self.args = args
+        self.out = os.path.join(args.output, '')
+        self.jobs = args.jobs
+
+        # Logger
+        logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=args.log_lvl)
+
+        # Check databases
+        self.check_db()
+
+        # Check input and output
+        self.load_genomes()
+        self.check_out()
+
+        # Get repeat lengths
+        self.repeatdb = os.path.join(self.args.db, 'repeats.fa')
+        self.len_df = read_len(self.repeatdb)
+
+    def check_db(self):
+        '''
+        Resolve the database directory once for all genomes
+        '''
+
+        if self.args.db == '':
+            try:
+                self.args.db = os.environ['SRUFINDER_DB']
+            except KeyError:
+                raise SRUFinderError('Could not find database directory')
+
+    def check_out(self):
+        '''
+        Create the output dir if possible, else raise an error
+        '''
+
+        try:
+            os.mkdir(self.out)
+        except FileExistsError:
+            if not self.args.resume:
+                raise SRUFinderError('Directory '+self.out+' already exists')
+
+    def load_genomes(self):
+        '''
+        Get the list of genomes from a directory of fasta files
+        or from a manifest with one path (and optionally a tab-separated name) per line
+        '''
+
+        self.genomes = []
+
+        if os.path.isdir(self.args.input):
+            for fn in sorted(os.listdir(self.args.input)):
+                path = os.path.join(self.args.input, fn)
+                if os.path.isfile(path) and fn.endswith(FASTA_EXT):
+                    self.genomes.append((genome_name(fn), path))
+
+        elif os.path.isfile(self.args.input):
+            root = os.path.dirname(os.path.abspath(self.args.input))
+            with open(self.args.input, 'r') as handle:
+                for line in handle:
+                    line = line.strip()
+                    if line == '' or line.startswith('#'):
+                        continue
+                    fields = line.split('\t')
+                    path = os.path.join(root, fields[0])
+                    if len(fields) > 1:
+                        name = fields[1]
+                    else:
+                        name = genome_name(os.path.basename(path))
+                    self.genomes.append((name, path))
+        else:
+            raise SRUFinderError('Could not find input manifest or directory')
+
+        if len(self.genomes) == 0:
+            raise SRUFinderError('No genomes found in input')
+
+        names = [x[0] for x in self.genomes]
+        if len(set(names)) < len(names):
+            raise SRUFinderError('Duplicate genome names detected!\nPlease ensure genomes have unique names.')
+
+    def run(self):
+        '''
+        Run the workflow on all genomes in a pool of worker processes
+        and write a status table
+        '''
+
+        logging.info('Running {} genome(s) with {} worker(s)'.format(len(self.genomes), self.jobs))
+
+        jobs = []
+        for name, path in self.genomes:
+            args = copy.copy(self.args)
+            args.input = path
+            args.output = self.out+name
+            del args.jobs
+            jobs.append((name, args))
+
+        with multiprocessing.Pool(self.jobs, initializer=_init_worker, initargs=(self.len_df, self.repeatdb)) as pool:
+            status = dict(pool.imap_unordered(_run_genome, jobs))
+
+        with open(self.out+'batch.tab', 'w') as f:
+            f.write('Genome\tInput\tStatus\tError\n')
+            for name, path in self.genomes:
+                f.write('{}\t{}\t{}\t{}\n'.format(name, path, *status[name]))
+
+        n_done = sum([x[0] == 'done' for x in status.values()])
+        logging.info('Finished {} of {} genome(s)'.format(n_done, len(self.genomes)))
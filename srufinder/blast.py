@@ -1,7 +1,16 @@
 import os
 import subprocess
 import logging
-import sys
+import shutil
+import tempfile
+
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+
+from srufinder import kmer
+from srufinder.sequences import Fasta, write_fasta, pipe_fasta
+from srufinder.profiling import profiled
 
 class Blast(object):
     
@@ -10,51 +19,207 @@ class Blast(object):
 
     def make_db(self, indb, outdb):
         '''
-        Make a BLAST database from the masked input sequence
+        Make a BLAST database from the masked input sequence,
+        or from (name, header, sequence) records fed through a pipe
         '''
 
         logging.debug('Making BLAST database')
 
-        subprocess.run(['makeblastdb', 
-                        '-dbtype', 'nucl', 
-                        '-in', indb,
-                        '-out', outdb], 
-                        stdout=subprocess.DEVNULL)
+        with self.master.profiler.stage('makeblastdb'):
+            if isinstance(indb, str):
+                subprocess.run(['makeblastdb', 
+                                '-dbtype', 'nucl', 
+                                '-in', indb,
+                                '-out', outdb], 
+                                stdout=subprocess.DEVNULL)
+            else:
+                pipe_fasta(['makeblastdb',
+                            '-dbtype', 'nucl',
+                            '-in', '-',
+                            '-title', os.path.basename(outdb),
+                            '-out', outdb],
+                            indb, subprocess.DEVNULL)
     
+    @profiled('blast')
     def run(self):
         '''
-        BLASTing repeat database against the masked input sequence
+        BLASTing repeat database against the masked input sequence,
+        or the unmasked input when splitting matches by ORFs
         '''
 
-        # Make the database
-        self.make_db(self.master.out+'masked.fna', self.master.out+'masked')
+        if self.master.out is None:
+            self.master.hits = self.run_memory()
+            return
+
+        # Reuse the output of a previous run if inputs are unchanged
+        key = self.master.stage_hash([self.master.fasta if self.master.orf_split else self.master.out+'masked.fna', self.master.querydb],
+                                     ['word_size', 'matcher', 'kmer_size'])
+        if self.master.reuse('blast', key):
+            return
+
+        if self.master.matcher == 'kmer':
+            self.run_kmer()
+        else:
+            self.run_blast()
+
+        self.master.finish('blast', key)
+
+    def run_blast(self):
+        '''
+        BLASTing repeat database against the masked input sequence with blastn
+        '''
+
+        # Make the database, of the unmasked input when splitting matches by ORFs
+        if not self.master.orf_split:
+            self.db = self.master.out+'masked'
+            self.make_db(self.master.out+'masked.fna', self.db)
+        elif self.master.plain:
+            self.db = self.master.out+'unmasked'
+            self.make_db(self.master.fasta, self.db)
+        else:
+            # Input which is not a plain fasta is fed to makeblastdb without writing a copy
+            self.db = self.master.out+'unmasked'
+            self.make_db(self.master.records(), self.db)
 
         logging.info('BLASTing repeats')
 
         # BLASTn
-        subprocess.run(['blastn', 
-                        '-task', 'blastn-short', 
-                        '-word_size', str(self.master.word_size), 
-                        '-query', self.master.repeatdb,
-                        '-db', self.master.out+'masked',
-                        '-outfmt', '6',
-                        '-out', self.master.out+'blast.tab',
-                        '-num_threads', str(self.master.threads)])
+        with self.master.profiler.stage('blastn'):
+            if self.master.threads > 1:
+                self.run_sharded()
+            else:
+                subprocess.run(['blastn', 
+                                '-task', 'blastn-short', 
+                                '-word_size', str(self.master.word_size), 
+                                '-query', self.master.querydb,
+                                '-db', self.db,
+                                '-outfmt', '6',
+                                '-out', self.master.out+'blast.tab',
+                                '-num_threads', str(self.master.threads)])
+
+    def run_sharded(self):
+        '''
+        BLASTing shards of the repeat database in parallel single-threaded processes,
+        and merging the outputs in query order.
+        The database is not split, such that e-values are the same as for a single run
+        '''
+
+        repeats = Fasta(self.master.querydb)
+        names = repeats.names()
+        n = min(self.master.threads, len(names))
+        size = -(-len(names) // n)
+
+        logging.debug('BLASTing {} shards of the repeat database'.format(n))
+
+        # Write shards
+        for i in range(n):
+            with open(self.master.out+'repeats_{}.fa'.format(i), 'w') as out_file:
+                for name in names[i*size:(i+1)*size]:
+                    write_fasta(out_file, repeats.header(name), repeats[name])
+
+        def run_shard(i):
+            subprocess.run(['blastn',
+                            '-task', 'blastn-short',
+                            '-word_size', str(self.master.word_size),
+                            '-query', self.master.out+'repeats_{}.fa'.format(i),
+                            '-db', self.db,
+                            '-outfmt', '6',
+                            '-out', self.master.out+'blast_{}.tab'.format(i),
+                            '-num_threads', '1'])
+
+        with ThreadPoolExecutor(n) as executor:
+            list(executor.map(run_shard, range(n)))
+
+        # Merge
+        with open(self.master.out+'blast.tab', 'wb') as out_file:
+            for i in range(n):
+                if os.path.isfile(self.master.out+'blast_{}.tab'.format(i)):
+                    with open(self.master.out+'blast_{}.tab'.format(i), 'rb') as shard_file:
+                        shutil.copyfileobj(shard_file, out_file)
+                    os.remove(self.master.out+'blast_{}.tab'.format(i))
+                os.remove(self.master.out+'repeats_{}.fa'.format(i))
     
+    def run_kmer(self):
+        '''
+        Matching repeat database against the masked input sequence with the k-mer matcher
+        '''
+
+        index = kmer.load_index(self.master.querydb, self.master.kmer_size)
+
+        logging.info('Matching repeats')
+
+        hits = index.search(self.master.sequences if self.master.orf_split else Fasta(self.master.out+'masked.fna'))
+        hits.to_csv(self.master.out+'blast.tab', sep='\t', header=False, index=False)
+
+        self.master.profiler.count('hits', len(hits))
+
+    def run_memory(self):
+        '''
+        Match the repeat database against in-memory masked sequences and return the hits.
+        blastn needs a database on disk, which is made in a temporary directory
+        '''
+
+        if self.master.matcher == 'kmer':
+            logging.info('Matching repeats')
+            return kmer.load_index(self.master.querydb, self.master.kmer_size).search(self.master.masked)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            masked = os.path.join(tmp, 'masked')
+            with open(masked+'.fna', 'w') as out_file:
+                for name, header, seq in self.master.masked.records():
+                    write_fasta(out_file, header, seq)
+            self.make_db(masked+'.fna', masked)
+
+            logging.info('BLASTing repeats')
+
+            with self.master.profiler.stage('blastn'):
+                subprocess.run(['blastn', 
+                                '-task', 'blastn-short', 
+                                '-word_size', str(self.master.word_size), 
+                                '-query', self.master.querydb,
+                                '-db', masked,
+                                '-outfmt', '6',
+                                '-out', masked+'.tab',
+                                '-num_threads', str(self.master.threads)])
+
+            if not os.path.isfile(masked+'.tab') or os.stat(masked+'.tab').st_size == 0:
+                return pd.DataFrame(columns=kmer.BLAST_COLUMNS)
+            return pd.read_csv(masked+'.tab', sep='\t', header=None, names=kmer.BLAST_COLUMNS)
+
+    @profiled('spacer')
     def run_spacer(self):
         '''
-        BLASTing repeat database against the masked input sequence
+        Matching spacers against the input masked by arrays, for self-targeting analysis
         '''
 
         # Run only if any array is found and analyis not skipped by user
         if self.master.selfmatch and os.path.isfile(self.master.out+'spacers.fa'):
-        
-            # Make the database
-            self.make_db(self.master.out+'genome.fna', self.master.out+'genome')
 
-            logging.info('BLASTing spacers against self')
+            # Reuse the output of a previous run if inputs are unchanged
+            key = self.master.stage_hash([self.master.out+'spacers.fa', self.master.out+'genome.fna'],
+                                         ['word_size', 'spacer_identity', 'spacer_coverage', 'matcher', 'kmer_size'])
+            if self.master.reuse('spacer', key):
+                return
+
+            if self.master.matcher == 'kmer':
+                self.run_spacer_kmer()
+            else:
+                self.run_spacer_blast()
+
+            self.master.finish('spacer', key)
+
+    def run_spacer_blast(self):
+        '''
+        BLASTing spacers against the input masked by arrays with blastn
+        '''
 
-            # BLASTn
+        # Make the database
+        self.make_db(self.master.out+'genome.fna', self.master.out+'genome')
+
+        logging.info('BLASTing spacers against self')
+
+        # BLASTn
+        with self.master.profiler.stage('blastn'):
             subprocess.run(['blastn', 
                             '-task', 'blastn-short', 
                             '-word_size', str(self.master.word_size), 
@@ -65,3 +230,27 @@ class Blast(object):
                             '-qcov_hsp_perc', str(self.master.spacer_coverage),
                             '-out', self.master.out+'blast_spacers.tab',
                             '-num_threads', str(self.master.threads)])
+
+    def run_spacer_kmer(self):
+        '''
+        Matching spacers against the input masked by arrays with the k-mer matcher,
+        keeping hits passing the spacer identity and coverage cutoffs as in the BLAST search
+        '''
+
+        logging.info('Matching spacers against self')
+
+        spacers = Fasta(self.master.out+'spacers.fa')
+        names = [x for x in spacers.names() if spacers.length(x) >= self.master.kmer_size]
+
+        if len(names) == 0:
+            open(self.master.out+'blast_spacers.tab', 'w').close()
+            return
+
+        index = kmer.KmerIndex(names, [spacers[x] for x in names], self.master.kmer_size)
+        hits = index.search(Fasta(self.master.out+'genome.fna'))
+
+        lengths = hits['Repeat'].map({x: spacers.length(x) for x in names})
+        hits = hits[(hits['Identity'] >= self.master.spacer_identity) &
+                    (hits['Alignment']/lengths*100 >= self.master.spacer_coverage)]
+
+        hits.to_csv(self.master.out+'blast_spacers.tab', sep='\t', header=False, index=False)
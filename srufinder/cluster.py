@@ -1,279 +1,518 @@
 import os
 import subprocess
 import logging
-import sys
 import re
+import multiprocessing
 
+import numpy as np
 import pandas as pd
 
-from Bio import pairwise2
-from Bio import SeqIO
-from Bio.Seq import Seq
+from functools import lru_cache
+
+from Bio.Align import PairwiseAligner
+
+from srufinder.intervals import IntervalSet, GeneIndex
+from srufinder import masking
+from srufinder.sequences import Fasta, write_fasta
+from srufinder.profiling import profiled
+
+# Score-only aligners with the scoring of pairwise2 globalxs/localxs(x, y, -1, -1),
+# without penalizing end gaps in the global alignment
+global_aligner = PairwiseAligner(mode='global', match_score=1, mismatch_score=0,
+                                 open_gap_score=-1, extend_gap_score=-1, end_gap_score=0)
+local_aligner = PairwiseAligner(mode='local', match_score=1, mismatch_score=0,
+                                open_gap_score=-1, extend_gap_score=-1)
+
+@lru_cache(maxsize=1<<16)
+def identity(x, y):
+    '''
+    Calculate identity between two sequences
+    '''
+    return(global_aligner.score(x, y)/min(len(x), len(y))*100)
+
+@lru_cache(maxsize=1<<16)
+def flankident(rep, flank):
+    '''
+    Calculate identity of the best local match of a sequence in a flank
+    '''
+    if len(rep) == 0 or len(flank) == 0:
+        return 0
+    return local_aligner.score(rep, flank)/len(rep)
+
+# Columns and dtypes of the BLAST table
+HIT_DTYPES = {'Repeat': 'category', 'Acc': str, 'Identity': np.float64,
+              'Alignment': np.int32, 'Mismatches': np.int32, 'Gaps': np.int32,
+              'Repeat_start': np.int32, 'Repeat_end': np.int32, 'Acc_start': np.int32, 'Acc_end': np.int32,
+              'Evalue': np.float64, 'Score': np.float64}
+
+# Rows of the BLAST table read at a time
+HIT_CHUNK = 1000000
+
+# Cluster object and batches of contigs shared with forked worker processes
+_partition = None
+
+def _chain_batch(ind):
+    '''
+    Run the clustering steps on a batch of contigs in a worker process
+    '''
+
+    cluster, batches = _partition
+    misses = identity.cache_info().misses
+    results = [cluster.chain(tmp) for tmp in batches[ind]]
+
+    return results, identity.cache_info().misses - misses
 
 class Cluster(object):
     
     def __init__(self, obj):
         self.master = obj
+        self.searched = None
 
+    @profiled('cluster')
     def run(self):
         '''
-        Load the BLAST table and run the different clustering steps
+        Load the BLAST table, run the different clustering steps, and write the results
         '''
 
-        # Load blast table and add lengths
-        self.df = pd.read_csv(self.master.out+'blast.tab', sep='\t', header=None,
-            names=('Repeat', 'Acc', 'Identity', 'Alignment', 'Mismatches', 'Gaps',
-                   'Repeat_start', 'Repeat_end', 'Acc_start', 'Acc_end', 'Evalue', 'Score'))
-        
-        # Calculate coverage
-        self.df = self.df.merge(self.master.len_df, left_on='Repeat', right_index=True)
-        self.df['Coverage'] = (self.df['Alignment']-self.df['Gaps'])/self.df['Repeat_len']*100
+        # In memory
+        if self.master.out is None:
+            self.clustering()
+            return
+
+        # Reuse the output of a previous run if inputs are unchanged
+        files = [self.master.out+'blast.tab', self.master.fasta, self.master.repeatdb]
+        if self.master.compact:
+            files.append(self.master.repeats.querydb)
+        if self.master.orf_split:
+            files.append(self.master.out+'prodigal.gff')
+        key = self.master.stage_hash(files, ['identity', 'coverage', 'score', 'coverage_part', 'max_dist', 'flank', 'orf_split', 'selfmatch'])
+        if self.master.reuse('cluster', key):
+            return
+
+        if self.master.orf_split:
+            self.split()
+        else:
+            self.clustering()
+            self.write()
+
+        self.master.finish('cluster', key)
+
+    def clustering(self):
+        '''
+        Load the matches, run the different clustering steps, and keep the SRUs, arrays, and spacers found
+        '''
 
-        # Filter by identity and coverage
-        self.df = self.df[self.df['Identity'] >= self.master.identity]
-        self.df = self.df[self.df['Coverage'] >= self.master.coverage_part]
+        # Load blast table, add lengths, and filter by identity and coverage
+        with self.master.profiler.stage('load_hits'):
+            self.load_hits()
+            self.master.profiler.count('hits', len(self.df))
+
+        self.cluster_hits()
+
+    def split(self):
+        '''
+        Split the matches of the unmasked input in intergenic and inside ORFs,
+        and cluster and write each set. Matches overlapping both are not kept.
+        Matches inside ORFs are tagged with the gene they overlap,
+        and their clusters are numbered after the intergenic clusters
+        '''
+
+        with self.master.profiler.stage('load_hits'):
+            self.load_hits()
+            self.master.profiler.count('hits', len(self.df))
+
+        with self.master.profiler.stage('classify'):
+            hits = self.classify(self.df)
+            self.master.profiler.count('intergenic', (~hits['Overlap']).sum())
+            self.master.profiler.count('inside_orf', hits['Inside'].sum())
+
+        logging.info('Clustering intergenic matches')
+        self.df = hits[~hits['Overlap']].drop(columns=['Overlap', 'Inside', 'ORF_start', 'ORF_end'])
+        self.cluster_hits()
+        self.write()
+        n_cluster = 0 if self.df_appended is None else self.df_appended['Cluster'].max() + 1
+
+        logging.info('Clustering matches inside ORFs')
+        self.df = hits[hits['Inside']].drop(columns=['Overlap', 'Inside'])
+        self.cluster_hits()
+        for df in (self.df_sru, self.df_arrays, self.df_spacers):
+            if len(df) > 0:
+                df['Cluster'] += n_cluster
+        self.write('_in_orf', genome=False)
+
+    def classify(self, hits):
+        '''
+        Add whether each match overlaps any of the filtered prodigal genes, whether it is inside genes,
+        and the start and end of an overlapping gene
+        '''
+
+        logging.debug('Classifying matches by ORFs')
+
+        index = GeneIndex(self.master.genes)
+        n = len(hits)
+        overlap = np.zeros(n, dtype=bool)
+        inside = np.zeros(n, dtype=bool)
+        orf_start = np.zeros(n, dtype=np.int64)
+        orf_end = np.zeros(n, dtype=np.int64)
+
+        low = np.minimum(hits['Acc_start'].values, hits['Acc_end'].values)
+        high = np.maximum(hits['Acc_start'].values, hits['Acc_end'].values)
+        for acc, ind in hits.groupby('Acc', observed=True).indices.items():
+            overlap[ind], inside[ind], orf_start[ind], orf_end[ind] = index.locate(acc, low[ind], high[ind])
+
+        return hits.assign(Overlap=overlap, Inside=inside, ORF_start=orf_start, ORF_end=orf_end)
+
+    def cluster_hits(self):
+        '''
+        Run the different clustering steps on the loaded matches,
+        and keep the SRUs, arrays, and spacers found
+        '''
+
+        self.df_overlap = None
+        self.df_appended = None
+        self.df_sru = pd.DataFrame()
+        self.df_arrays = pd.DataFrame()
+        self.df_spacers = pd.DataFrame(columns=['Acc', 'Cluster', 'Spacer', 'Sequence'])
 
         # Check if any matches
         if len(self.df) == 0:
             logging.info('No matches with identity >= {}% found'.format(self.master.identity))
-            self.master.clean()
-            sys.exit()
+            return
 
         # Create new columns
         self.df['Min'] = [min(x,y) for x,y in zip(self.df['Acc_start'],self.df['Acc_end'])]
         self.df['Max'] = [max(x,y) for x,y in zip(self.df['Acc_start'],self.df['Acc_end'])]
 
-        # Keep only best matches if overlapping
-        self.remove_overlap()
+        # Remove overlaps, cluster matches in arrays, and append partial matches on each contig
+        with self.master.profiler.stage('partition'):
+            self.partition()
 
-        # Add repeats
-        self.add_repeats()
-
-        # Cluster matches in arrays
-        self.cluster_adj()
-
-        # Append partial matches
-        self.append_partial()
+        # Check if any complete matches
+        if self.df_appended is None:
+            logging.info('No matches with score >= {} and coverage >= {}% found'.format(self.master.score, self.master.coverage))
+            return
 
         # Round
         logging.debug('Rounding columns')
         self.df_appended = self.df_appended.round({'Identity': 1, 'Coverage': 1})
         self.df_appended['Evalue'] = ['{:0.1e}'.format(x) for x in self.df_appended['Evalue']]
-        
+    
         # Split in SRU and arrays
         logging.debug('Splitting in SRUs and arrays')
         count_dict = self.df_appended.groupby('Cluster')['Cluster'].count().to_dict()
         cluster_sru = [x for x in count_dict if count_dict[x] == 1]
         cluster_array = [x for x in count_dict if count_dict[x] > 1]
-      
+  
         # If any SRUs
         if len(cluster_sru) > 0:
-        
+    
             self.df_sru = self.df_appended[self.df_appended['Cluster'].isin(cluster_sru)]
-            self.add_flank()
-            # Post-hoc check of SRUs.
-            # Check if they are part of an array, but the remainder of is not found by BLAST or the array is inside a false ORF, which was masked in the initial search
-            self.flankmatch()        
+            with self.master.profiler.stage('flanks'):
+                misses = flankident.cache_info().misses
+                self.add_flank()
+                # Post-hoc check of SRUs.
+                # Check if they are part of an array, but the remainder of is not found by BLAST or the array is inside a false ORF, which was masked in the initial search
+                self.flankmatch()        
+                self.master.profiler.count('srus', len(self.df_sru))
+                self.master.profiler.count('alignments', flankident.cache_info().misses - misses)
             self.df_sru = self.df_sru.round({'Left_match': 2, 'Right_match': 2})
-            
-            # Write 
-            self.df_sru.to_csv(self.master.out+'SRUs.tab', index=False, sep='\t')
-        
+    
         # If any arrays
         if len(cluster_array) > 0:
 
             self.df_array = self.df_appended[self.df_appended['Cluster'].isin(cluster_array)]
-            self.convert_array()
-            self.df_arrays.to_csv(self.master.out+'arrays.tab', index=False, sep='\t')
+            with self.master.profiler.stage('arrays'):
+                self.convert_array()
+                self.master.profiler.count('arrays', len(self.df_arrays))
 
         logging.info('Found {} SRU(s) and {} CRISPR array(s)'.format(len(cluster_sru), len(cluster_array)))
 
-    def overlap(self,x,y):
+    def write(self, suffix='', genome=True):
         '''
-        Evaluate whether two (start,end) tuples overlap
+        Write the matches without overlaps, SRUs, arrays, spacers,
+        and the input masked by arrays if genome is True and spacers are self-matched,
+        now or when the shards are merged.
+        Files of matches inside ORFs are named with a suffix
         '''
-        return x[0] <= y[1] and y[0] <= x[1]
 
-    def overlap_any(self,x,ll):
-        '''
-        Evaluate whether a (start,end) tuple has overlap with any in a list of tuples
-        '''
-        return any([self.overlap(x,y) for y in ll])
+        if self.df_overlap is not None:
+            self.df_overlap.to_csv(self.master.out+'blast_best{}.tab'.format(suffix), index=False, sep='\t')
 
-    def dist(self,x,y):
-        '''
-        Calculate distance between two (start,end) tuples
-        '''
-        return y[0]-x[1] if y[0]>x[1] else x[0]-y[1]
+        if len(self.df_sru) > 0:
+            self.df_sru.to_csv(self.master.out+'SRUs{}.tab'.format(suffix), index=False, sep='\t')
+
+        if len(self.df_arrays) > 0:
+            self.df_arrays.to_csv(self.master.out+'arrays{}.tab'.format(suffix), index=False, sep='\t')
+
+            with open(self.master.out+'spacers{}.fa'.format(suffix), 'w') as f:
+                for acc, cl, n, sp in self.df_spacers.itertuples(index=False):
+                    f.write('>{}_{}:{}\n'.format(acc, cl, n))
+                    f.write('{}\n'.format(sp))
 
-    def dist_all(self,x,ll):
+            if genome and (self.master.selfmatch or self.master.shard):
+                self.write_genome()
+
+    def load_hits(self, path=None):
         '''
-        Get all distances between a (start,end) tuple and a list of tuples
+        Stream the BLAST table in chunks with compact dtypes, or take the hits kept in memory,
+        and keep only matches passing identity and coverage cutoffs,
+        such that memory is bounded by the matches kept.
+        The BLAST table of the output directory is read unless another path is given
         '''
-        return [self.dist(x,y) for y in ll]
-    
-    def identity(self,x,y):
+
+        repeats = pd.CategoricalDtype(sorted(self.master.len_df.index))
+        lengths = self.master.len_df['Repeat_len'].reindex(repeats.categories).values.astype(np.int32)
+        dtypes = dict(HIT_DTYPES, Repeat=repeats)
+
+        if path is None and self.master.out is not None:
+            path = self.master.out+'blast.tab'
+
+        chunks = []
+        if path is None:
+            chunks.append(self.filter_hits(self.master.hits.astype(dtypes), lengths))
+        elif os.stat(path).st_size > 0:
+            reader = pd.read_csv(path, sep='\t', header=None,
+                names=list(HIT_DTYPES), dtype=dtypes, chunksize=HIT_CHUNK)
+            for chunk in reader:
+                chunks.append(self.filter_hits(chunk, lengths))
+
+        if len(chunks) > 0:
+            self.df = pd.concat(chunks, ignore_index=True)
+        else:
+            self.df = pd.DataFrame({x: pd.Series(dtype=y) for x, y in dtypes.items()}).assign(Repeat_len=0, Coverage=0.0)
+
+        self.df['Acc'] = self.df['Acc'].astype(pd.CategoricalDtype(sorted(set(self.df['Acc']))))
+
+    def filter_hits(self, chunk, lengths):
         '''
-        Calculate identity between two sequences
+        Expand hits of representative repeats which may pass the cutoffs if the database is compacted,
+        add repeat lengths and coverage to a chunk of hits,
+        and keep only hits passing identity and coverage cutoffs
         '''
-        align = pairwise2.align.globalxs(x, y, -1, -1, penalize_end_gaps=False)
-        return(align[0][2]/min(len(x), len(y))*100)
 
-    def identity_all(self,x,ll):
+        if self.master.compact:
+            if self.searched is None:
+                # Members are rescored against the sequence searched, which is masked unless splitting by ORFs
+                if self.master.out is None:
+                    self.searched = self.master.masked
+                elif self.master.orf_split:
+                    self.searched = self.master.sequences
+                else:
+                    self.searched = Fasta(self.master.out+'masked.fna')
+
+            # Only expand hits passing the cutoffs or which may pass them with a member
+            chunk = chunk[chunk['Repeat'].notna()]
+            coverage = (chunk['Alignment']-chunk['Gaps']).values/lengths[chunk['Repeat'].cat.codes.values]*100
+            passes = (chunk['Identity'].values >= self.master.identity) & (coverage >= self.master.coverage_part)
+            chunk = chunk[self.master.repeats.reachable(chunk, self.searched, passes, self.master.identity, self.master.coverage_part)]
+            chunk = self.master.repeats.expand(chunk, self.searched)
+
+        # Add lengths, only for repeats in the database
+        chunk = chunk[chunk['Repeat'].notna()]
+        chunk.insert(len(chunk.columns), 'Repeat_len', lengths[chunk['Repeat'].cat.codes.values])
+        
+        # Calculate coverage
+        chunk.insert(len(chunk.columns), 'Coverage', (chunk['Alignment']-chunk['Gaps'])/chunk['Repeat_len']*100)
+
+        # Filter by identity and coverage
+        return chunk[(chunk['Identity'] >= self.master.identity) & (chunk['Coverage'] >= self.master.coverage_part)]
+
+    def identity_any(self,x,ll):
         '''
-        Calculate identity between one sequence and a list of sequences
+        Evaluate whether a sequence has identity above the cutoff with any in a list of sequences
         '''
-        return([self.identity(x, y) for y in ll])
+        return any(identity(x, y) >= self.master.identity for y in ll)
 
-    def remove_overlap(self):
+    def partition(self):
         '''
-        If matches overlap keep only the best
+        Partition matches by contig and run the clustering steps on each contig,
+        in a pool of worker processes if more threads are available.
+        Cluster IDs are numbered in contig order
         '''
 
-        logging.info('Removing overlapping matches')
+        logging.info('Removing overlapping matches and clustering matches')
+
+        contigs = [tmp for _, tmp in self.df.groupby('Acc', observed=True, sort=True)]
+
+        # Worker processes can not be started from daemonic processes, e.g. in batch mode
+        n = min(self.master.threads, len(contigs))
+        if n > 1 and not multiprocessing.current_process().daemon:
+            global _partition
+            n_batch = min(4*n, len(contigs))
+            _partition = (self, [contigs[i::n_batch] for i in range(n_batch)])
+            with multiprocessing.get_context('fork').Pool(n) as pool:
+                batches = pool.map(_chain_batch, range(n_batch))
+            _partition = None
+            results = [None]*len(contigs)
+            n_align = 0
+            for i, (batch, misses) in enumerate(batches):
+                results[i::n_batch] = batch
+                n_align += misses
+        else:
+            misses = identity.cache_info().misses
+            results = [self.chain(tmp) for tmp in contigs]
+            n_align = identity.cache_info().misses - misses
+
+        self.df_overlap = pd.concat([x[0] for x in results])
+
+        # Renumber clusters
+        append_lst = []
+        offset = 0
+        for _, appended in results:
+            if appended is not None:
+                append_lst.append(appended.assign(Cluster=appended['Cluster'] + offset))
+                offset += appended['Cluster'].max() + 1
 
-        # Sort by alignment quality
-        self.df = self.df.sort_values(['Acc', 'Score', 'Coverage'], ascending=False) 
+        if len(append_lst) == 0:
+            self.df_appended = None
+            return
 
-        overlap_lst = []
-        for i in set(self.df['Acc']):
-            tmp = self.df[self.df['Acc'] == i]
-            
-            # First remove those with similar start or end
-            tmp = tmp.drop_duplicates('Min')
-            tmp = tmp.drop_duplicates('Max')
-            tmp = tmp.drop_duplicates('Acc_start')
-            tmp = tmp.drop_duplicates('Acc_end')
-
-            # Then traverse through matches comparing only with previous
-            pos = tmp[['Min','Max']].values
-            keep = []
-            matches_all = []
-            # For each match
-            for ind, k in enumerate(pos):
-                # If no overlaps with any previous, keep
-                if not self.overlap_any(k, matches_all):
-                    keep.append(ind)
-                    matches_all.append(k)
-
-            overlap_lst.append(tmp.iloc[keep,:])
-        
-        # If several contigs, concatenate
-        self.df_overlap = pd.concat(overlap_lst)
+        self.df_appended = pd.concat(append_lst)
+        self.df_appended = self.df_appended.sort_values(['Acc', 'Min']) 
+        self.df_appended = self.df_appended.drop(columns=['Acc_start','Acc_end'])
+        self.df_appended = self.df_appended.rename(columns={'Min':'Start', 'Max':'End'})
 
-        # Write
-        self.df_overlap.to_csv(self.master.out+'blast_best.tab', index=False, sep='\t')
-    
-    def cluster_adj(self):
+        self.master.profiler.count('hits_no_overlap', len(self.df_overlap))
+        self.master.profiler.count('clusters', offset)
+        self.master.profiler.count('partials_appended', ((self.df_appended['Coverage'] < self.master.coverage) | (self.df_appended['Score'] < self.master.score)).sum())
+        self.master.profiler.count('alignments', n_align)
+
+    def chain(self, tmp):
         '''
-        Cluster adjacent matches into arrays
+        Run the clustering steps on the matches of a single contig.
+        Return the matches without overlaps, and the clustered matches
+        with clusters numbered from 0, or None if no complete matches
         '''
 
-        logging.info('Clustering matches')
+        # Keep only best matches if overlapping
+        kept = self.remove_overlap(tmp)
+
+        # Add repeats
+        overlap = self.add_repeats(kept)
 
         # Sort by position
-        self.df_overlap = self.df_overlap.sort_values('Min')
+        overlap = overlap.sort_values('Min')
 
         # Split in high and low coverage or score
-        self.df_overlap_compl = self.df_overlap[(self.df_overlap['Coverage'] >= self.master.coverage) & (self.df_overlap['Score'] >= self.master.score)]
-        self.df_overlap_part = self.df_overlap[(self.df_overlap['Coverage'] < self.master.coverage) | (self.df_overlap['Score'] < self.master.score)]
+        compl = overlap[(overlap['Coverage'] >= self.master.coverage) & (overlap['Score'] >= self.master.score)]
+        part = overlap[(overlap['Coverage'] < self.master.coverage) | (overlap['Score'] < self.master.score)]
 
-        if len(self.df_overlap_compl) == 0:
-            logging.info('No matches with score >= {} and coverage >= {}% found'.format(self.master.score, self.master.coverage))
-            self.master.clean()
-            sys.exit()
-
-        cluster_df_lst = []
-        cluster = 0
-        # For each contig
-        for i in set(self.df_overlap_compl['Acc']):
-            tmp = self.df_overlap_compl[self.df_overlap_compl['Acc'] == i]
-
-            pos = tmp[['Min','Max']].values
-            cluster_list = []
-            # Loop over complete matches
-            for ind, k in enumerate(pos):
-                # Keep first match
-                if ind == 0:
-                    cluster_list.append(cluster)
-                    arrays_cluster = [k]
-                else:
-                    # If match within Xbp of any previous, add match to current cluster
-                    if min(self.dist_all(k, arrays_cluster)) <= self.master.max_dist:
-                        cluster_list.append(cluster)
-                        arrays_cluster.append(k)
-                    # If match > Xbp from previous, initiate new cluster
-                    else:
-                        cluster += 1
-                        arrays_cluster = [k]
-                        cluster_list.append(cluster)
-            
-            tmp.insert(len(tmp.columns), 'Cluster', cluster_list)
-            cluster_df_lst.append(tmp)
-            
-            # Increment cluster ID for next acc
-            cluster += 1
+        if len(compl) == 0:
+            return kept, None
 
+        # Cluster matches in arrays
+        clustered = self.cluster_adj(compl)
 
-        # If several contigs, concatenate
-        self.df_cluster = pd.concat(cluster_df_lst)
+        # Append partial matches
+        return kept, self.append_partial(clustered, part)
 
-    def append_partial(self):
+    def remove_overlap(self, tmp):
         '''
-        Check if there are any partial matches near clusters
+        If matches on a contig overlap keep only the best
         '''
 
-        logging.debug('Appending partial repeats')
+        # Sort by alignment quality
+        tmp = tmp.sort_values(['Score', 'Coverage'], ascending=False, kind='mergesort')
+
+        # First remove those with similar start or end
+        tmp = tmp.drop_duplicates('Min')
+        tmp = tmp.drop_duplicates('Max')
+        tmp = tmp.drop_duplicates('Acc_start')
+        tmp = tmp.drop_duplicates('Acc_end')
+
+        # Then traverse through matches comparing only with previous
+        pos = tmp[['Min','Max']].values.tolist()
+        keep = []
+        matches_all = IntervalSet()
+        # For each match
+        for ind, k in enumerate(pos):
+            # If no overlaps with any previous, keep
+            if not matches_all.overlaps(k[0], k[1]):
+                keep.append(ind)
+                matches_all.add(k[0], k[1])
+
+        return tmp.iloc[keep,:]
+    
+    def cluster_adj(self, compl):
+        '''
+        Cluster adjacent complete matches into arrays
+        '''
+
+        # Sort by contig and position
+        tmp = compl.sort_values(['Acc', 'Min'], kind='mergesort')
+
+        # As matches are sorted by start, the distance to the closest previous match
+        # is the distance to the largest end seen so far on the contig
+        new_acc = (tmp['Acc'] != tmp['Acc'].shift()).values
+        prev_max = tmp.groupby('Acc', sort=False, observed=True)['Max'].cummax().shift().values
+        dists = tmp['Min'].values - prev_max
+
+        # Initiate new cluster on each contig and when a match is > Xbp from all previous
+        new_cluster = new_acc | (dists > self.master.max_dist)
+
+        return tmp.assign(Cluster=np.cumsum(new_cluster) - 1)
+
+    def append_partial(self, clustered, part):
+        '''
+        Check if there are any partial matches near clusters on a contig
+        '''
 
         append_lst = []
         # For each cluster
-        for cl in set(self.df_cluster['Cluster']):
-            tmp = self.df_cluster[self.df_cluster['Cluster'] == cl]
-            tmp_part = self.df_overlap_part[self.df_overlap_part['Acc'] == list(tmp['Acc'])[0]]
+        for cl, tmp in clustered.groupby('Cluster', sort=True):
            
             # Distances between cluster position and partial matches
-            cluster_start = min(tmp['Min'])
-            cluster_end = max(tmp['Max'])
+            cluster_start = tmp['Min'].min()
+            cluster_end = tmp['Max'].max()
 
-            dists = self.dist_all((cluster_start, cluster_end), zip(list(tmp_part['Min']),list(tmp_part['Max'])))
+            dists = np.where(part['Min'].values > cluster_end, part['Min'].values - cluster_end, cluster_start - part['Max'].values)
             
             # Only if any partial matches adjacent
-            part_adj = tmp_part[[x < self.master.max_dist and x > 0 for x in dists]]
+            part_adj = part[(dists < self.master.max_dist) & (dists > 0)]
             if len(part_adj) > 0:
 
                 # Only those with similar sequences
-                idents = part_adj.apply(lambda row: any([k >= self.master.identity for k in self.identity_all(str(row['Sequence']), [str(x) for x in tmp['Sequence'].values])]), axis=1)
-                part_adj = part_adj[idents.values] 
+                # Compare each unique partial sequence once with the unique sequences of the cluster
+                cluster_seqs = set(str(x) for x in tmp['Sequence'].values)
+                part_seqs = [str(x) for x in part_adj['Sequence'].values]
+                similar = {x: self.identity_any(x, cluster_seqs) for x in set(part_seqs)}
+                part_adj = part_adj[[similar[x] for x in part_seqs]]
                 
                 if len(part_adj) > 0:
-                    part_adj.insert(len(part_adj.columns), 'Cluster', cl)
+                    part_adj = part_adj.assign(Cluster=cl)
                     tmp = pd.concat([tmp, part_adj])
                 
             append_lst.append(tmp)
 
-        self.df_appended = pd.concat(append_lst)
-        self.df_appended = self.df_appended.sort_values(['Acc', 'Min']) 
-        self.df_appended = self.df_appended.drop(columns=['Acc_start','Acc_end'])
-        self.df_appended = self.df_appended.rename(columns={'Min':'Start', 'Max':'End'})
+        return pd.concat(append_lst)
         
-    def get_sequence(self, acc, start, end):
+    def get_sequences(self, accs, starts, ends):
         '''
-        Return sequence from position information
+        Return sequences of many windows from position information at once
         '''
 
-        if start < 1:
-            start = 1
-        
-        return(''.join(self.master.sequences[str(acc)][(start-1):end]))
+        starts = np.maximum(np.asarray(starts, dtype=np.int64), 1)
+
+        return self.master.sequences.extract(np.asarray(accs).astype(str), starts-1, np.asarray(ends, dtype=np.int64))
+
+    def get_flanks(self, df):
+        '''
+        Return the left and right flanking sequences of all rows at once
+        '''
 
-    def add_repeats(self):
+        accs = np.concatenate((df['Acc'].values, df['Acc'].values))
+        starts = np.concatenate((df['Start'].values-1-self.master.flank, df['End'].values+1))
+        ends = np.concatenate((df['Start'].values-1, df['End'].values+1+self.master.flank))
+        flanks = self.get_sequences(accs, starts, ends)
+
+        return flanks[:len(df)], flanks[len(df):]
+
+    def add_repeats(self, tmp):
         '''
         Add repeats to the no-overlap dataframe
         '''
-        
-        logging.debug('Adding repeat sequences')
 
-        self.df_overlap.insert(len(self.df_overlap.columns), 'Sequence', self.df_overlap.apply(lambda row: self.get_sequence(row['Acc'], row['Min'], row['Max']), axis=1))
+        return tmp.assign(Sequence=self.get_sequences(tmp['Acc'], tmp['Min'], tmp['Max']))
 
     def add_flank(self):
         '''
@@ -282,8 +521,9 @@ class Cluster(object):
        
         logging.debug('Adding flanking sequences')
 
-        self.df_sru.insert(len(self.df_sru.columns), 'Left_flank', self.df_sru.apply(lambda row: self.get_sequence(row['Acc'], row['Start']-1-self.master.flank, row['Start']-1), axis=1))
-        self.df_sru.insert(len(self.df_sru.columns), 'Right_flank', self.df_sru.apply(lambda row: self.get_sequence(row['Acc'], row['End']+1, row['End']+1+self.master.flank), axis=1))
+        left, right = self.get_flanks(self.df_sru)
+        self.df_sru.insert(len(self.df_sru.columns), 'Left_flank', left)
+        self.df_sru.insert(len(self.df_sru.columns), 'Right_flank', right)
 
     def flankmatch(self):
         '''
@@ -292,14 +532,6 @@ class Cluster(object):
        
         logging.debug('Post-hoc filter of SRUs')
 
-        # Define a function for calculating identity of best match
-        def flankident(rep, flank):
-            score = pairwise2.align.localxs(rep, flank, -1, -1, score_only=True)
-            if isinstance(score, float):
-                return score/len(rep)
-            else:
-                return 0
-
         # Apply for each flank
         self.df_sru.insert(len(self.df_sru.columns), 'Left_match', self.df_sru.apply(lambda x: flankident(x.Sequence, x.Left_flank), axis=1))
         self.df_sru.insert(len(self.df_sru.columns), 'Right_match', self.df_sru.apply(lambda x: flankident(x.Sequence, x.Right_flank), axis=1))
@@ -309,28 +541,35 @@ class Cluster(object):
         '''
         Convert array dataframe such that each array is one row
         Add spacers to arrays
-        Mask input by arrays for self-matching
         '''
 
         logging.debug('Converting array dataframe')
 
-        f = open(self.master.out+'spacers.fa', 'w')
+        # Get spacers between consecutive repeats of all arrays at once
+        groups = self.df_array.groupby('Cluster').indices
+        ind = np.concatenate(list(groups.values()))
+        cl = self.df_array['Cluster'].values[ind]
+        same = cl[1:] == cl[:-1]
+        spacer_seqs = self.get_sequences(self.df_array['Acc'].values[ind][1:][same],
+                                         self.df_array['End'].values[ind][:-1][same]+1,
+                                         self.df_array['Start'].values[ind][1:][same]-1)
+        bounds = np.concatenate(([0], np.cumsum([len(x)-1 for x in groups.values()])))
+        spacer_dict = {k: spacer_seqs[bounds[i]:bounds[i+1]] for i, k in enumerate(groups)}
 
         # For each array
         cls = set(self.df_array['Cluster'])
         dict_lst = []
+        spacer_lst = []
         for cl in cls:
-            tmp = self.df_array[self.df_array['Cluster'] == cl]
+            tmp = self.df_array.iloc[groups[cl]]
             acc = list(tmp['Acc'])[0]
             n = 0
 
-            # Get spacers
-            spacers = [str(self.get_sequence(acc, x[0]+1, x[1]-1)) for x in zip(tmp['End'][:(len(tmp)-1)], tmp['Start'][1:])]
+            spacers = spacer_dict[cl]
 
             for sp in spacers:
                 n += 1
-                f.write('>{}_{}:{}\n'.format(acc, cl, n))
-                f.write('{}\n'.format(sp))
+                spacer_lst.append((acc, cl, n, sp))
 
             # Compile
             dict_lst.append({'Acc': acc,
@@ -342,37 +581,35 @@ class Cluster(object):
                             'Spacers': spacers})
         
         self.df_arrays = pd.DataFrame(dict_lst)
-        
-        f.close()
+
+        # Arrays inside ORFs span the ORFs their repeats are in
+        if 'ORF_start' in self.df_array.columns:
+            orfs = self.df_array.groupby('Cluster').agg(ORF_start=('ORF_start', 'min'), ORF_end=('ORF_end', 'max'))
+            self.df_arrays.insert(3, 'ORF_start', orfs['ORF_start'].reindex(self.df_arrays['Cluster']).values)
+            self.df_arrays.insert(4, 'ORF_end', orfs['ORF_end'].reindex(self.df_arrays['Cluster']).values)
+
+        self.df_spacers = pd.DataFrame(spacer_lst, columns=['Acc', 'Cluster', 'Spacer', 'Sequence'])
 
         # Add flanks
-        self.df_arrays.insert(len(self.df_arrays.columns), 'Left_flank', self.df_arrays.apply(lambda row: self.get_sequence(row['Acc'], row['Start']-1-self.master.flank, row['Start']-1), axis=1))
-        self.df_arrays.insert(len(self.df_arrays.columns), 'Right_flank', self.df_arrays.apply(lambda row: self.get_sequence(row['Acc'], row['End']+1, row['End']+1+self.master.flank), axis=1))
+        left, right = self.get_flanks(self.df_arrays)
+        self.df_arrays.insert(len(self.df_arrays.columns), 'Left_flank', left)
+        self.df_arrays.insert(len(self.df_arrays.columns), 'Right_flank', right)
+
+    def write_genome(self):
+        '''
+        Write the input masked by arrays for self-matching
+        '''
 
-        # Mask input by arrays
         logging.debug('Masking input sequence by arrays')
         
+        arrays = {k: v for k, v in self.df_arrays.groupby('Acc', sort=False)}
+
         with open(self.master.out+'genome.fna', 'w') as out_file:
-            falist = SeqIO.parse(open(self.master.fasta, 'r'), 'fasta')
             # For each sequence
-            for fas in falist:
-                name = str(fas.id)
-                Xsub = self.df_arrays[[x == name for x in self.df_arrays['Acc']]]
+            for name, header, seq in self.master.sequences.records():
+                Xsub = arrays.get(name)
                 # Only fastas found in Xtable
-                if not Xsub.empty:
-                    seq = str(fas.seq)
-                    # Each row of Xtable
-                    for row in Xsub.itertuples():
-                        # From where to where
-                        Xfrom = row[2]
-                        Xto = row[3]
-                        # New sequence
-                        seq1 = seq[:int(Xfrom) - 1]
-                        seqX = 'N'*(Xto-Xfrom+1)
-                        seq2 = seq[int(Xto):]
-                        seq = seq1+seqX+seq2
-                    fas.seq = Seq(seq)
+                if Xsub is not None:
+                    seq = masking.mask(seq, Xsub['Start'], Xsub['End'])
                 # Write sequence
-                SeqIO.write(fas, out_file, "fasta")
-
-        
+                write_fasta(out_file, header, seq)
@@ -1,22 +1,66 @@
 import os
-import logging
 import sys
+import gzip
+import logging
 import pkg_resources
 import glob
+import shutil
+import hashlib
 
 import pandas as pd
 
 from Bio import SeqIO
 
+from srufinder.sequences import Fasta, Genome, parse_fasta
+from srufinder.errors import SRUFinderError
+from srufinder.profiling import Profiler
+from srufinder import repeats
+
+# First bytes of gzip and bgzip files
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Output files of each stage which can be reused by resumed runs,
+# as files always written and files only written if anything is found
+STAGE_OUTPUTS = {'prodigal': (['prodigal.gff'], []),
+                 'masking': (['masked.fna'], []),
+                 'blast': (['blast.tab'], []),
+                 'cluster': (['blast_best.tab'], ['SRUs.tab', 'arrays.tab', 'spacers.fa', 'genome.fna',
+                                                  'blast_best_in_orf.tab', 'SRUs_in_orf.tab', 'arrays_in_orf.tab', 'spacers_in_orf.fa']),
+                 'spacer': (['blast_spacers.tab'], [])}
+
+def read_len(repeatdb):
+    '''
+    Read the repeat database and return a table of repeat lengths,
+    from the prebuilt repeat table if there is one
+    '''
+
+    prebuilt = repeats.load(os.path.dirname(repeatdb))
+    if prebuilt is not None:
+        return prebuilt.len_df
+
+    with open(repeatdb, 'r') as handle:
+        fas = SeqIO.parse(handle, 'fasta')
+        len_dict = {}
+        for fa in fas:
+            len_dict[str(fa.id)] = len(fa.seq)
+
+    return pd.DataFrame.from_dict(len_dict, orient='index', columns=['Repeat_len'])
+
 class Controller(object):
 
-    def __init__(self, args):
+    def __init__(self, args, len_df=None, sequences=None):
         '''
         Initialize master object by:
         Getting arguments from input
         Starting the logger
         Checking database, input, and output
         Write the arguments to a file
+
+        A preloaded repeat length table can be given with len_df,
+        so that batch runs only parse the repeat database once.
+
+        If in-memory sequences are given, there is no input file or output directory,
+        and the stages pass their results in memory
         '''
 
         self.fasta = args.input
@@ -37,6 +81,27 @@ class Controller(object):
         self.spacer_coverage = args.spacer_coverage
         self.selfmatch = args.selfmatch
         self.in_orf = args.in_orf
+        self.orf_split = args.orf_split
+        self.matcher = args.matcher
+        self.kmer_size = args.kmer_size
+        self.resume = args.resume
+        self.stream_mb = args.stream_mb
+        self.no_compact = args.no_compact
+
+        self.shard = args.shard
+
+        # Pretrained prodigal model, used when the input is split for prodigal
+        self.training = args.training
+
+        # In memory
+        if sequences is not None:
+            self.fasta = None
+            self.out = None
+            self.sequences = sequences
+            self.profiler = Profiler(self.out)
+            self.check_db()
+            self.len_df = read_len(self.repeatdb) if len_df is None else len_df
+            return
 
         # Logger
         logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=self.log_lvl)
@@ -45,6 +110,9 @@ class Controller(object):
         # Force consistency
         self.out = os.path.join(self.out, '')
 
+        # Resource use of each step
+        self.profiler = Profiler(self.out, args.profile, args.cprofile)
+
         # Check databases
         self.check_db()
         
@@ -53,7 +121,10 @@ class Controller(object):
         self.check_out()
 
         # Get repeat lengths
-        self.get_len()
+        if len_df is None:
+            self.get_len()
+        else:
+            self.len_df = len_df
 
         # Write arguments
         da = vars(args)
@@ -70,30 +141,102 @@ class Controller(object):
         try:
             os.mkdir(self.out)
         except FileExistsError:
-            logging.error('Directory '+self.out+' already exists')
-            sys.exit()
+            if not self.resume:
+                raise SRUFinderError('Directory '+self.out+' already exists')
+            logging.info('Resuming in directory '+self.out)
+
+        self.load_checkpoints()
 
     def load_input(self):
         '''
-        Check that input file exists and that it looks like a fasta
+        Check that input file exists and that it looks like a fasta,
+        and index it for random access to the sequences.
+        Gzip or bgzip compressed input, and input from stdin given as -,
+        is decompressed once and kept in memory.
+        With --stream_mb such input is not kept, but decompressed batch by batch
         '''
 
-        if os.path.isfile(self.fasta):
-            try:
-                self.sequences = {}
-                with open(self.fasta, 'r') as handle:
-                    for rec in SeqIO.parse(handle, 'fasta'):
-                        if rec.id in self.sequences:
-                            logging.error('Duplicate fasta headers detected!\nPlease ensure input has unique headers without spaces.')
-                            sys.exit()
-                        self.sequences[rec.id] = rec.seq
-
-            except:
-                logging.error('Input file is in bad format')
-                sys.exit()
-        else:
-            logging.error('Could not find input file')
-            sys.exit()
+        if self.fasta != '-' and not os.path.isfile(self.fasta):
+            raise SRUFinderError('Could not find input file')
+
+        self.source = None
+        try:
+            if self.fasta == '-':
+                if self.stream_mb > 0:
+                    self.sequences = None
+                    self.plain = False
+                else:
+                    self.read_stream(sys.stdin.buffer)
+            else:
+                with open(self.fasta, 'rb') as handle:
+                    compressed = handle.read(2) == GZIP_MAGIC
+                if compressed and self.stream_mb > 0:
+                    self.source = self.fasta
+                    self.sequences = None
+                    self.plain = False
+                elif compressed:
+                    with gzip.open(self.fasta, 'rb') as handle:
+                        self.read_stream(handle)
+                else:
+                    self.sequences = Fasta(self.fasta)
+                    self.plain = True
+        except (ValueError, OSError, EOFError) as e:
+            if str(e).startswith('Duplicate'):
+                raise SRUFinderError('Duplicate fasta headers detected!\nPlease ensure input has unique headers without spaces.')
+            raise SRUFinderError('Input file is in bad format')
+
+    def read_stream(self, handle):
+        '''
+        Read the sequences from a binary stream into memory,
+        and hash the stream such that resumed runs can check if the input changed
+        '''
+
+        h = hashlib.sha256()
+
+        def lines():
+            for line in handle:
+                if self.resume:
+                    h.update(line)
+                yield line.decode()
+
+        self.sequences = Genome(parse_fasta(lines()))
+        self.stream_hash = h.hexdigest()
+        self.plain = False
+
+    def spool(self):
+        '''
+        Keep input from stdin, which is not kept in memory, compressed in the output directory,
+        such that it can be read more than once
+        '''
+
+        self.source = self.out+'input.fna.gz'
+        with gzip.open(self.source, 'wb', compresslevel=1) as out_file:
+            shutil.copyfileobj(sys.stdin.buffer, out_file)
+
+    def records(self):
+        '''
+        Iterate over (name, header, sequence) of the input.
+        Input which is not kept in memory is decompressed again for each pass
+        '''
+
+        if self.sequences is not None:
+            yield from self.sequences.records()
+            return
+
+        names = set()
+        try:
+            with gzip.open(self.source, 'rt') as handle:
+                for header, seq in parse_fasta(handle):
+                    header = header.strip()
+                    name = header.split()[0] if header else ''
+                    if name == '':
+                        raise ValueError('Empty fasta header')
+                    if name in names:
+                        raise SRUFinderError('Duplicate fasta headers detected!\nPlease ensure input has unique headers without spaces.')
+                    names.add(name)
+                    yield name, header, seq
+        except (ValueError, OSError, EOFError):
+            raise SRUFinderError('Input file is in bad format')
 
     def check_db(self):
         '''
@@ -104,39 +247,141 @@ class Controller(object):
         if self.db == '':
             try:
                 self.db = os.environ['SRUFINDER_DB']
-            except:
-                logging.error('Could not find database directory')
-                sys.exit()
+            except KeyError:
+                raise SRUFinderError('Could not find database directory')
 
         self.repeatdb = os.path.join(self.db, "repeats.fa")
 
+        # Search only the representative repeats if the database has been compacted
+        self.repeats = repeats.load(os.path.dirname(self.repeatdb))
+        self.compact = self.repeats is not None and self.repeats.compacted and not self.no_compact
+        self.querydb = self.repeats.querydb if self.compact else self.repeatdb
+
     def get_len(self):
         '''
         Get lengths of all repeat sequences for coverage calculation later
         '''
 
-        with open(self.repeatdb, 'r') as handle:
-            fas = SeqIO.parse(handle, 'fasta')
-            len_dict = {}
-            for fa in fas:
-                len_dict[str(fa.id)] = len(fa.seq)
+        if self.repeats is not None:
+            self.len_df = self.repeats.len_df
+        else:
+            self.len_df = read_len(self.repeatdb)
+
+    def load_checkpoints(self):
+        '''
+        Load the input hashes of the stages finished in a previous run
+        '''
+
+        self.checkpoints = {}
+        self.file_hashes = {}
+
+        if self.resume and os.path.isfile(self.out+'checkpoints.tab'):
+            with open(self.out+'checkpoints.tab', 'r') as f:
+                for line in f:
+                    stage, key = line.rstrip('\n').split('\t')
+                    self.checkpoints[stage] = key
+
+    def hash_file(self, path):
+        '''
+        Hash the content of a file, once per file version
+        '''
+
+        # Input from stdin
+        if path == '-':
+            return self.stream_hash
+
+        stat = os.stat(path)
+        version = (path, stat.st_size, stat.st_mtime_ns)
+        if version not in self.file_hashes:
+            h = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            self.file_hashes[version] = h.hexdigest()
+
+        return self.file_hashes[version]
+
+    def stage_hash(self, files, params):
+        '''
+        Hash the input files and the arguments a stage depends on.
+        Nothing is hashed unless resuming is enabled
+        '''
+
+        if not self.resume:
+            return None
+
+        h = hashlib.sha256()
+        for path in files:
+            h.update(self.hash_file(path).encode())
+        for param in params:
+            h.update('{}={};'.format(param, getattr(self, param)).encode())
+
+        return h.hexdigest()
+
+    def reuse(self, stage, key):
+        '''
+        Check if a stage can be skipped because it finished with the same inputs in a previous run
+        '''
+
+        if not self.resume:
+            return False
+
+        required, optional = STAGE_OUTPUTS[stage]
+        if self.checkpoints.get(stage) == key and all(os.path.isfile(self.out+x) for x in required):
+            logging.info('Reusing {} output from previous run'.format(stage))
+            return True
+
+        # Remove outdated output
+        for path in [self.out+x for x in required + optional]:
+            if os.path.isfile(path):
+                os.remove(path)
+        self.checkpoints.pop(stage, None)
+        self.write_checkpoints()
+
+        return False
+
+    def finish(self, stage, key):
+        '''
+        Record that a stage finished with the given inputs
+        '''
+
+        if not self.resume:
+            return
 
-        self.len_df = pd.DataFrame.from_dict(len_dict, orient='index', columns=['Repeat_len']) 
+        self.checkpoints[stage] = key
+        self.write_checkpoints()
+
+    def write_checkpoints(self):
+        '''
+        Write the input hashes of finished stages
+        '''
+
+        with open(self.out+'checkpoints.tab', 'w') as f:
+            for stage, key in self.checkpoints.items():
+                f.write('{}\t{}\n'.format(stage, key))
 
     def clean(self):
         '''
-        Removing temporary files
+        Removing temporary files.
+        When resuming is enabled intermediate files are kept for later runs
         '''
 
+        if self.resume or self.out is None:
+            return
+
         logging.debug('Removing temporary files')
 
         if os.path.isfile(self.out+'masked.fna'):
             list(map(os.remove, glob.glob(self.out+'masked*')))
+
+        list(map(os.remove, glob.glob(self.out+'unmasked*')))
         
-        if os.path.isfile(self.out+'genome.fna'):
+        # Shards keep the input masked by arrays for self-matching across shards
+        if os.path.isfile(self.out+'genome.fna') and not self.shard:
             list(map(os.remove, glob.glob(self.out+'genome*')))
 
         if os.path.isfile(self.out+'flanking.fna'):
             os.remove(self.out+'flanking.fna')
         
-        os.remove(self.out+'prodigal.gff')
+        if os.path.isfile(self.out+'prodigal.gff'):
+            os.remove(self.out+'prodigal.gff')
@@ -0,0 +1,5 @@
+class SRUFinderError(Exception):
+    '''
+    Raised when a run can not continue, e.g. because of bad input or a failed external tool.
+    The command line scripts log the message and exit
+    '''
@@ -0,0 +1,113 @@
+import bisect
+
+import numpy as np
+
+class IntervalSet(object):
+    '''
+    A set of non-overlapping closed (start,end) intervals kept sorted by start,
+    such that overlap with any interval in the set is found by bisection.
+    Intervals are stored in blocks of bounded size to keep insertion cheap
+    '''
+
+    load = 512
+
+    def __init__(self):
+        self.firsts = []
+        self.starts = []
+        self.ends = []
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def overlaps(self, start, end):
+        '''
+        Evaluate whether a (start,end) interval overlaps any interval in the set.
+        As the intervals are disjoint their ends are sorted too, so only the
+        interval with the largest start <= end can overlap
+        '''
+
+        block = bisect.bisect_right(self.firsts, end) - 1
+        if block < 0:
+            return False
+        ind = bisect.bisect_right(self.starts[block], end) - 1
+        return self.ends[block][ind] >= start
+
+    def add(self, start, end):
+        '''
+        Add a (start,end) interval which does not overlap any in the set
+        '''
+
+        self.n += 1
+
+        if len(self.firsts) == 0:
+            self.firsts.append(start)
+            self.starts.append([start])
+            self.ends.append([end])
+            return
+
+        block = max(bisect.bisect_right(self.firsts, start) - 1, 0)
+        starts = self.starts[block]
+        ends = self.ends[block]
+        ind = bisect.bisect_right(starts, start)
+        starts.insert(ind, start)
+        ends.insert(ind, end)
+        self.firsts[block] = starts[0]
+
+        # Split full blocks in two
+        if len(starts) > 2*self.load:
+            self.starts[block:block+1] = [starts[:self.load], starts[self.load:]]
+            self.ends[block:block+1] = [ends[:self.load], ends[self.load:]]
+            self.firsts[block:block+1] = [starts[0], starts[self.load]]
+
+class GeneIndex(object):
+    '''
+    The genes of each contig sorted by start, for classifying matches
+    as intergenic or inside genes, and finding the gene a match overlaps
+    '''
+
+    def __init__(self, genes):
+
+        self.contigs = {}
+        for acc, tmp in genes.groupby('Acc', sort=False, observed=True):
+            tmp = tmp.sort_values('Start', kind='mergesort')
+            starts = tmp['Start'].values.astype(np.int64)
+            ends = tmp['End'].values.astype(np.int64)
+
+            # Gene reaching furthest among those starting at or before each gene
+            reach = np.maximum.accumulate(ends)
+            furthest = np.maximum.accumulate(np.where(ends == reach, np.arange(len(ends)), 0))
+
+            # Merge overlapping and adjacent genes to find stretches without intergenic positions
+            new = np.concatenate(([True], starts[1:] > reach[:-1] + 1))
+            last = np.concatenate((np.nonzero(new)[0][1:] - 1, [len(starts) - 1]))
+
+            self.contigs[acc] = (starts, ends, furthest, starts[new], reach[last])
+
+    def locate(self, acc, start, end):
+        '''
+        For closed (start,end) intervals on a contig, get whether they overlap any gene,
+        whether they are inside genes, and the start and end of an overlapping gene (0 if none)
+        '''
+
+        start = np.asarray(start, dtype=np.int64)
+        end = np.asarray(end, dtype=np.int64)
+        none = np.zeros(len(start), dtype=np.int64)
+
+        if acc not in self.contigs:
+            return none.astype(bool), none.astype(bool), none, none
+
+        starts, ends, furthest, merged_starts, merged_ends = self.contigs[acc]
+
+        # Last gene starting before the end, or the gene reaching furthest before it
+        ind = np.searchsorted(starts, end, 'right') - 1
+        found = ind >= 0
+        ind = np.maximum(ind, 0)
+        gene = np.where(ends[ind] >= start, ind, furthest[ind])
+        overlap = found & (ends[gene] >= start)
+
+        # Inside the stretch of genes covering the start
+        seg = np.searchsorted(merged_starts, start, 'right') - 1
+        inside = (seg >= 0) & (merged_ends[np.maximum(seg, 0)] >= end)
+
+        return overlap, inside, np.where(overlap, starts[gene], 0), np.where(overlap, ends[gene], 0)
@@ -0,0 +1,253 @@
+import math
+import functools
+
+import numpy as np
+import pandas as pd
+
+from srufinder.sequences import Fasta
+
+# Scoring as blastn-short (reward 1, penalty -3) with the matching Karlin-Altschul parameters
+REWARD = 1
+PENALTY = -3
+LAMBDA = 1.374
+K = 0.711
+
+# Score of positions beyond the ends of sequences
+BARRIER = -1000
+
+# Codes of A, C, G, T are 0-3, ambiguous bases are 4, and sequence separators are 5
+CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    CODES[ord(base)] = i
+    CODES[ord(base.lower())] = i
+SEP = 5
+
+# Genome positions scanned at a time, and seeds extended at a time
+CHUNK = 1 << 22
+BATCH = 1 << 16
+
+BLAST_COLUMNS = ('Repeat', 'Acc', 'Identity', 'Alignment', 'Mismatches', 'Gaps',
+                 'Repeat_start', 'Repeat_end', 'Acc_start', 'Acc_end', 'Evalue', 'Score')
+
+def encode(seq):
+    '''
+    Convert a sequence to an array of base codes
+    '''
+
+    return CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+def revcomp(codes):
+    '''
+    Reverse complement an array of base codes
+    '''
+
+    return np.where(codes < 4, 3 - codes, codes)[::-1]
+
+def kmers(codes, k):
+    '''
+    Get the 2-bit packed k-mer starting at each position,
+    and whether the k-mer only has unambiguous bases
+    '''
+
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+
+    val = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        val = (val << np.uint64(2)) | (codes[j:j+n] & 3).astype(np.uint64)
+
+    bad = np.concatenate(([0], np.cumsum(codes > 3)))
+    valid = bad[k:k+n] == bad[:n]
+
+    return val, valid
+
+def bitscore(score):
+    '''
+    Convert raw scores to bit scores
+    '''
+
+    return (LAMBDA*score - math.log(K))/math.log(2)
+
+def concatenate(fasta):
+    '''
+    Concatenate the base codes of all sequences of an indexed fasta with separators.
+    Return the codes, the names and lengths of the sequences, and the offset of each sequence
+    '''
+
+    names = fasta.names()
+    lengths = np.array([fasta.length(x) for x in names], dtype=np.int64)
+
+    offsets = np.concatenate(([0], np.cumsum(lengths + 1)))
+    genome = np.full(offsets[-1], SEP, dtype=np.uint8)
+    for i, name in enumerate(names):
+        genome[offsets[i]:offsets[i]+lengths[i]] = encode(fasta[name])
+
+    return genome, names, lengths, offsets
+
+def max_segment(scores):
+    '''
+    Find the maximum scoring segment of each row of position scores.
+    Return the start and end (exclusive) of the segments and their scores
+    '''
+
+    n, width = scores.shape
+
+    # Maximum segment from prefix sums
+    prefix = np.zeros((n, width+1), dtype=np.int64)
+    np.cumsum(scores, axis=1, out=prefix[:, 1:])
+    runmin = np.minimum.accumulate(prefix, axis=1)
+    qto = np.argmax(prefix - runmin, axis=1)
+    rows = np.arange(n)
+    best = prefix[rows, qto] - runmin[rows, qto]
+
+    # Start after the last minimum before the end
+    at_min = (prefix == runmin[rows, qto][:, None]) & (np.arange(width+1) <= qto[:, None])
+    qfrom = width - np.argmax(at_min[:, ::-1], axis=1)
+
+    return qfrom, qto, best
+
+@functools.lru_cache(maxsize=4)
+def load_index(path, k):
+    '''
+    Build the k-mer index of a fasta file, once per process
+    '''
+
+    fasta = Fasta(path)
+    names = fasta.names()
+    return KmerIndex(names, [fasta[x] for x in names], k)
+
+class KmerIndex(object):
+    '''
+    An index of all k-mers in a set of short query sequences, in both orientations,
+    for finding ungapped matches of the queries in a genome by seed-and-extend
+    '''
+
+    def __init__(self, names, seqs, k):
+
+        self.k = k
+        self.names = np.array(names, dtype=object)
+        self.lengths = np.array([len(x) for x in seqs], dtype=np.int64)
+        self.n = len(seqs)
+        self.width = int(self.lengths.max())
+
+        # Queries in both orientations as a padded matrix, reverse complements after forward
+        codes = [encode(x) for x in seqs]
+        codes += [revcomp(x) for x in codes]
+        self.queries = np.full((2*self.n, self.width), SEP, dtype=np.uint8)
+        for i, x in enumerate(codes):
+            self.queries[i, :len(x)] = x
+
+        # All k-mers of all queries
+        val, valid = kmers(self.queries.ravel(), k)
+        pos = np.arange(len(val))
+        qid = pos // self.width
+        qpos = pos % self.width
+        valid &= qpos + k <= self.width
+
+        order = np.argsort(val[valid], kind='mergesort')
+        self.keys = val[valid][order]
+        self.qid = qid[valid][order].astype(np.int32)
+        self.qpos = qpos[valid][order].astype(np.int32)
+
+    def search(self, fasta):
+        '''
+        Find matches of the queries in all sequences of an indexed fasta.
+        Return a dataframe with the same columns as the BLAST table
+        '''
+
+        genome, names, lengths, offsets = concatenate(fasta)
+
+        hits = []
+        for start in range(0, len(genome), CHUNK):
+            end = min(start + CHUNK + self.k - 1, len(genome))
+            seeds = self.seed(genome[start:end], start)
+            for i in range(0, len(seeds[0]), BATCH):
+                hits.append(self.extend(genome, seeds[0][i:i+BATCH], seeds[1][i:i+BATCH]))
+
+        hits = pd.DataFrame(np.concatenate(hits) if hits else np.zeros((0, 5), dtype=np.int64),
+                            columns=['qid', 'diag', 'qfrom', 'qto', 'score'])
+        hits = hits[hits['qto'] - hits['qfrom'] >= self.k].drop_duplicates(['qid', 'diag'])
+
+        return self.table(hits, names, lengths, offsets)
+
+    def seed(self, codes, shift):
+        '''
+        Find k-mers shared between a genome chunk and the queries.
+        Return query IDs and diagonals (genome position minus query position) of unique seeds
+        '''
+
+        val, valid = kmers(codes, self.k)
+        gpos = np.nonzero(valid)[0]
+        val = val[valid]
+
+        lo = np.searchsorted(self.keys, val, 'left')
+        hi = np.searchsorted(self.keys, val, 'right')
+        cnt = hi - lo
+
+        # Expand each genome k-mer to all its query k-mers
+        gpos = np.repeat(gpos, cnt)
+        ind = np.repeat(lo - np.concatenate(([0], np.cumsum(cnt)[:-1])), cnt) + np.arange(cnt.sum())
+
+        qid = self.qid[ind].astype(np.int64)
+        diag = gpos + shift - self.qpos[ind]
+
+        # Unique query-diagonal pairs
+        key = np.unique((diag + self.width) * (2*self.n) + qid)
+
+        return key % (2*self.n), key // (2*self.n) - self.width
+
+    def extend(self, genome, qid, diag):
+        '''
+        Find the maximum scoring segment of each query on its diagonal
+        '''
+
+        cols = np.arange(self.width)
+        gind = diag[:, None] + cols
+        outside = (gind < 0) | (gind >= len(genome))
+        g = genome[np.clip(gind, 0, len(genome)-1)]
+        q = self.queries[qid]
+
+        scores = np.where((g == q) & (q < 4), REWARD, PENALTY)
+        scores[outside | (g == SEP) | (q == SEP)] = BARRIER
+
+        qfrom, qto, best = max_segment(scores)
+
+        return np.column_stack((qid, diag, qfrom, qto, best))
+
+    def table(self, hits, names, lengths, offsets):
+        '''
+        Convert segments to BLAST tabular output
+        '''
+
+        qid = hits['qid'].values
+        minus = qid >= self.n
+        rep = np.where(minus, qid - self.n, qid)
+        qlen = self.lengths[rep]
+        qfrom = hits['qfrom'].values
+        qto = hits['qto'].values
+        aln = qto - qfrom
+        score = hits['score'].values
+        matches = (score - PENALTY*aln) // (REWARD - PENALTY)
+
+        # Genome coordinates in contigs
+        gfrom = hits['diag'].values + qfrom
+        contig = np.searchsorted(offsets, gfrom, 'right') - 1
+        gfrom = gfrom - offsets[contig] + 1
+        gto = gfrom + aln - 1
+
+        df = pd.DataFrame({'Repeat': self.names[rep],
+                           'Acc': np.array(names, dtype=object)[contig],
+                           'Identity': np.round(matches/aln*100, 3),
+                           'Alignment': aln,
+                           'Mismatches': aln - matches,
+                           'Gaps': 0,
+                           'Repeat_start': np.where(minus, qlen - qto + 1, qfrom + 1),
+                           'Repeat_end': np.where(minus, qlen - qfrom, qto),
+                           'Acc_start': np.where(minus, gto, gfrom),
+                           'Acc_end': np.where(minus, gfrom, gto),
+                           'Evalue': K*qlen*lengths.sum()*np.exp(-LAMBDA*score),
+                           'Score': np.round(bitscore(score), 1)},
+                          columns=BLAST_COLUMNS)
+
+        return df.sort_values(['Repeat', 'Acc', 'Score'], ascending=[True, True, False])
@@ -0,0 +1,41 @@
+import numpy as np
+
+def mask(seq, starts, ends):
+    '''
+    Replace all closed 1-based (start,end) intervals of a sequence with N's.
+    All intervals are applied in a single pass over a mutable buffer
+    '''
+
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    buf = np.frombuffer(bytearray(seq.encode()), dtype=np.uint8)
+    if len(starts) == 0 or len(buf) == 0:
+        return seq
+
+    # Count intervals covering each position
+    cover = np.zeros(len(buf)+1, dtype=np.int32)
+    np.add.at(cover, np.clip(starts-1, 0, len(buf)), 1)
+    np.add.at(cover, np.clip(ends, 0, len(buf)), -1)
+
+    buf[np.cumsum(cover[:-1]) > 0] = ord('N')
+
+    return buf.tobytes().decode()
+
+def intergenic(starts, ends, length):
+    '''
+    Get the closed 1-based (start,end) intervals between genes,
+    with genes given by their starts and ends sorted by start
+    '''
+
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    # Regions from the end of one gene to the start of the next
+    reg_from = np.concatenate(([1], ends))
+    reg_to = np.concatenate((starts, [length]))
+
+    # Remove empty intergenic regions
+    keep = reg_to - reg_from > 1
+
+    return reg_from[keep]+1, reg_to[keep]-1
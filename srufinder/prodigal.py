@@ -1,14 +1,63 @@
 import os
+import io
 import subprocess
 import logging
-import sys
-import re
+import array
 
+import numpy as np
 import pandas as pd
 
-from Bio import SeqIO
-from Bio.Seq import Seq
 from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
+
+from srufinder import masking
+from srufinder.sequences import Genome, write_fasta, pipe_fasta, balance
+from srufinder.errors import SRUFinderError
+
+def read_gff(handle, orf):
+    '''
+    Stream a prodigal gff and get contig, start, end, strand, and confidence
+    of the ORFs with a confidence of at least orf.
+    Return the ORFs as a dataframe with compact dtypes, and the number of ORFs before filtering
+    '''
+
+    accs = []
+    starts = array.array('l')
+    ends = array.array('l')
+    strands = array.array('b')
+    confs = array.array('f')
+    n_genes = 0
+
+    for line in handle:
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t', 8)
+        if len(fields) < 9:
+            continue
+        n_genes += 1
+
+        # Confidence from the attributes
+        attr = fields[8]
+        ind = attr.find('conf=')
+        if ind == -1:
+            continue
+        conf = float(attr[ind+5:attr.find(';', ind)])
+
+        # Remove low confidence
+        if conf >= orf:
+            accs.append(fields[0])
+            starts.append(int(fields[3]))
+            ends.append(int(fields[4]))
+            strands.append(1 if fields[6] == '+' else -1)
+            confs.append(conf)
+
+    genes = pd.DataFrame({'Acc': pd.Categorical(accs),
+                          'Start': np.frombuffer(starts, dtype=starts.typecode).astype(np.int32),
+                          'End': np.frombuffer(ends, dtype=ends.typecode).astype(np.int32),
+                          'Strand': np.frombuffer(strands, dtype=np.int8),
+                          'Conf': np.frombuffer(confs, dtype=np.float32)})
+
+    return genes, n_genes
 
 class Prodigal(object):
     
@@ -19,28 +68,178 @@ class Prodigal(object):
         '''
         Running prodigal to predict ORFs in the input sequence.
         Then check if the run was succesful, load the gff file, 
-        and create a sequence masked with the ORFs
+        and create a sequence masked with the ORFs, or keep the genes when splitting matches by ORFs
         '''
 
-        logging.info('Predicting ORFs with prodigal')
+        if self.master.out is None:
+            self.run_memory()
+            return
 
-        # Run prodigal
-        with open(self.master.out+'prodigal.gff', 'w') as prodigal_out:
-            subprocess.run(['prodigal', 
-                            '-i', self.master.fasta, 
-                            '-p', self.master.prod,
-                            '-f', 'gff'], 
-                            stdout=prodigal_out, 
-                            stderr=subprocess.DEVNULL)
-
-        # Check if succesful
-        self.check()
-        
-        # Load genes and filter
-        self.get_genes()
+        with self.master.profiler.stage('prodigal'):
+
+            # Run prodigal unless the output of a previous run can be reused
+            files = [self.master.fasta]
+            if self.master.training is not None:
+                files.append(self.master.training)
+            key = self.master.stage_hash(files, ['prod'])
+            if not self.master.reuse('prodigal', key):
+
+                logging.info('Predicting ORFs with prodigal')
+
+                if self.master.threads > 1 and len(self.master.sequences) > 1:
+                    self.run_sharded()
+                else:
+                    with open(self.master.out+'prodigal.gff', 'w') as prodigal_out:
+                        self.run_input(['-p', self.master.prod,
+                                        '-f', 'gff'] + self.training_args(),
+                                       prodigal_out)
+
+                # Check if succesful
+                self.check()
+
+                self.master.finish('prodigal', key)
+            
+            # Load genes and filter
+            self.get_genes()
+
+        # Matches are split by the genes instead of masking
+        if self.master.orf_split:
+            self.master.genes = self.genes
+            return
 
         # Mask fasta
-        self.mask()
+        with self.master.profiler.stage('masking'):
+            key = self.master.stage_hash([self.master.fasta, self.master.out+'prodigal.gff'], ['orf', 'in_orf'])
+            if not self.master.reuse('masking', key):
+                self.mask()
+                self.master.finish('masking', key)
+
+    def run_memory(self):
+        '''
+        Run prodigal on in-memory sequences through pipes,
+        and keep the masked sequences in memory
+        '''
+
+        with self.master.profiler.stage('prodigal'):
+
+            logging.info('Predicting ORFs with prodigal')
+
+            fasta = io.StringIO()
+            for name, header, seq in self.master.sequences.records():
+                write_fasta(fasta, header, seq)
+            prodigal = subprocess.run(['prodigal', 
+                                       '-p', self.master.prod,
+                                       '-f', 'gff'], 
+                                       input=fasta.getvalue(),
+                                       stdout=subprocess.PIPE, 
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True)
+
+            if prodigal.stdout == '':
+                raise SRUFinderError('Prodigal failed!')
+
+            self.load_genes(io.StringIO(prodigal.stdout))
+
+        with self.master.profiler.stage('masking'):
+            if self.noorf:
+                self.master.masked = self.master.sequences
+            else:
+                logging.info('Masking input sequence')
+                self.master.masked = Genome(self.masked_records())
+
+    def shards(self, n):
+        '''
+        Split the contigs in n shards of similar total length
+        '''
+
+        return balance(self.master.sequences, n)
+
+    def run_sharded(self):
+        '''
+        Run prodigal on shards of the input in parallel and merge the gff files.
+        In single mode the model is trained once on the whole input and used for all shards
+        '''
+
+        shards = self.shards(min(self.master.threads, len(self.master.sequences)))
+
+        logging.debug('Running prodigal on {} shards'.format(len(shards)))
+
+        # Train on the whole input unless a model is given
+        trained = self.master.prod == 'single' and self.master.training is None
+        if trained:
+            self.master.training = self.train(self.master.out+'prodigal.trn')
+
+        cmd = ['prodigal', '-f', 'gff', '-p', self.master.prod] + self.training_args()
+
+        # Each shard is fed to prodigal through a pipe
+        def run_shard(i):
+            sequences = self.master.sequences
+            with open(self.master.out+'prodigal_{}.gff'.format(i), 'w') as prodigal_out:
+                pipe_fasta(cmd, sequences.records(shards[i]), prodigal_out)
+
+        with ThreadPoolExecutor(len(shards)) as executor:
+            list(executor.map(run_shard, range(len(shards))))
+
+        # Split shard outputs by sequence, each starting with a sequence data comment
+        blocks = {}
+        for i, shard in enumerate(shards):
+            with open(self.master.out+'prodigal_{}.gff'.format(i), 'r') as handle:
+                seq_blocks = []
+                for line in handle:
+                    if line.startswith('# Sequence Data'):
+                        seq_blocks.append([])
+                    if len(seq_blocks) > 0:
+                        seq_blocks[-1].append(line)
+            blocks.update(zip(shard, seq_blocks))
+
+        # Merge in input order
+        with open(self.master.out+'prodigal.gff', 'w') as prodigal_out:
+            if len(blocks) > 0:
+                prodigal_out.write('##gff-version  3\n')
+            for name in self.master.sequences.names():
+                if name in blocks:
+                    prodigal_out.writelines(blocks[name])
+
+        # Remove shard outputs
+        for i in range(len(shards)):
+            os.remove(self.master.out+'prodigal_{}.gff'.format(i))
+        if trained:
+            os.remove(self.master.training)
+            self.master.training = None
+
+    def train(self, training):
+        '''
+        Train a prodigal model on the whole input and write it to a training file
+        '''
+
+        self.run_input(['-p', 'single',
+                        '-t', training],
+                       subprocess.DEVNULL)
+
+        return training
+
+    def run_input(self, args, stdout):
+        '''
+        Run prodigal on the whole input.
+        Input which is not a plain fasta file is fed to prodigal through a pipe
+        '''
+
+        if self.master.plain:
+            subprocess.run(['prodigal', '-i', self.master.fasta] + args,
+                           stdout=stdout,
+                           stderr=subprocess.DEVNULL)
+            return
+
+        pipe_fasta(['prodigal'] + args, self.master.records(), stdout)
+
+    def training_args(self):
+        '''
+        Arguments for using a pretrained model in single mode
+        '''
+
+        if self.master.prod == 'single' and self.master.training is not None:
+            return ['-t', self.master.training]
+        return []
 
     def check(self):
         '''
@@ -52,8 +251,7 @@ class Prodigal(object):
 
         # Check prodigal output
         if os.stat(self.master.out+'prodigal.gff').st_size == 0:
-            logging.critical('Prodigal failed!')
-            sys.exit()
+            raise SRUFinderError('Prodigal failed!')
 
     def get_genes(self):
         '''
@@ -63,80 +261,74 @@ class Prodigal(object):
 
         logging.debug('Loading prodigal GFF')
 
-        try:
-            genes = pd.read_csv(self.master.out+'prodigal.gff', sep='\t|;[a-z,A-Z,_]*=', comment="#", engine='python', header=None)
-       
-            # Remove low confidence
-            self.genes = genes[genes.iloc[:,14] >= self.master.orf]
-        
-            self.noorf = False
-        
-        except:
+        with open(self.master.out+'prodigal.gff', 'r') as handle:
+            self.load_genes(handle)
+
+    def load_genes(self, handle):
+        '''
+        Read the genes from a prodigal gff
+        '''
+
+        self.genes, n_genes = read_gff(handle, self.master.orf)
+
+        self.master.profiler.count('genes', n_genes)
+        self.master.profiler.count('genes_kept', len(self.genes))
+
+        if n_genes == 0:
             logging.warning('No ORFs found. Skipping masking')
             self.noorf = True
+        else:
+            self.noorf = False
 
     def mask(self):
         '''
         Masking input by replacing all ORF or non-ORF sequences with N's
         '''
 
-        if self.noorf:
+        if self.noorf and self.master.plain:
             copyfile(self.master.fasta, self.master.out+'masked.fna')
+        elif self.noorf:
+            with open(self.master.out+'masked.fna', 'w') as out_file:
+                for name, header, seq in self.master.sequences.records():
+                    write_fasta(out_file, header, seq)
         else:
 
             logging.info('Masking input sequence')
-            
+
             with open(self.master.out+'masked.fna', 'w') as out_file:
-                falist = SeqIO.parse(open(self.master.fasta, 'r'), 'fasta')
-                # For each sequence
-                for fas in falist:
-                    
-                    name = str(fas.id)
-                    seq = str(fas.seq)
-                    Xsub = self.genes[[x == name for x in self.genes.iloc[:,0]]]
-                    
-                    # If non-ORFs should be masked
-                    if self.master.in_orf:
-                        # If no ORFs, all is intergenic
-                        if Xsub.empty:
-                            seq = 'N'*len(seq)
-                        else:
-                            # Ensure the order is correct
-                            Xsub = Xsub.sort_values(by = 3)
-                            # Get intergenic regions
-                            starts = [1] + list(Xsub.iloc[:,4])
-                            ends = list(Xsub.iloc[:,3]) + [len(fas.seq)]
-                            # Combine
-                            overlap = [x[1]-x[0] for x in zip(starts, ends)]
-                            intergenic = zip(starts, ends, overlap)
-                            # Remove empty intergenic regions
-                            intergenic = [x for x in intergenic if x[2] > 1]
-                            # For each intergenic region
-                            for reg in intergenic:
-                                Xfrom = int(reg[0])
-                                Xto = int(reg[1])
-                                # New sequence
-                                seq1 = seq[:Xfrom]
-                                seqX = 'N'*(Xto-Xfrom-1)
-                                seq2 = seq[Xto-1:]
-                                seq = seq1+seqX+seq2
-                    
-                    # If ORFs should be masked    
-                    else:
-                        # Only fastas found in Xtable
-                        if not Xsub.empty:
-                            # Each row of Xtable
-                            for row in Xsub.itertuples():
-                                # From where to where
-                                Xfrom = row[4]
-                                Xto = row[5]
-                                # New sequence
-                                seq1 = seq[:int(Xfrom) - 1]
-                                seqX = 'N'*(Xto-Xfrom+1)
-                                seq2 = seq[int(Xto):]
-                                seq = seq1+seqX+seq2
-                    
-                    fas.seq = Seq(seq)
-                    # Write sequence
-                    SeqIO.write(fas, out_file, "fasta")
+                for header, seq in self.masked_records():
+                    write_fasta(out_file, header, seq)
+
+    def masked_records(self):
+        '''
+        Iterate over (header, sequence) of the input masked by the ORFs,
+        or by the intergenic regions if searching inside ORFs
+        '''
+
+        # Group genes by contig
+        genes = {k: v for k, v in self.genes.groupby('Acc', sort=False, observed=True)}
+
+        # For each sequence
+        for name, header, seq in self.master.sequences.records():
+            
+            Xsub = genes.get(name)
+            
+            # If non-ORFs should be masked
+            if self.master.in_orf:
+                # If no ORFs, all is intergenic
+                if Xsub is None:
+                    seq = 'N'*len(seq)
+                else:
+                    # Ensure the order is correct
+                    Xsub = Xsub.sort_values(by = 'Start')
+                    # Mask intergenic regions
+                    Xfrom, Xto = masking.intergenic(Xsub['Start'], Xsub['End'], len(seq))
+                    seq = masking.mask(seq, Xfrom, Xto)
+            
+            # If ORFs should be masked    
+            else:
+                # Only fastas found in Xtable
+                if Xsub is not None:
+                    seq = masking.mask(seq, Xsub['Start'], Xsub['End'])
 
+            yield header, seq
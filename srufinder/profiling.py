@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import resource
+import cProfile
+import functools
+
+from contextlib import contextmanager
+
+def profiled(name):
+    '''
+    Record the resources used by a method of an object with the controller as master as a stage
+    '''
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.master.profiler.stage(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+
+    return decorator
+
+class Profiler(object):
+    '''
+    Record wall time, CPU time (including child processes), peak RSS,
+    and row counts of the stages of a run.
+    Stages can be nested, and are named by their path, e.g. cluster.load_hits.
+    Stages run more than once, e.g. for each batch in streaming mode, are summed
+    '''
+
+    def __init__(self, out, enabled=False, cprofile=False):
+
+        self.out = out
+        self.enabled = enabled or cprofile
+        self.cprofile = cprofile
+        self.stages = {}
+        self.profiles = {}
+        self.stack = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Record the resources used inside a with block.
+        Top-level stages are profiled with cProfile if requested
+        '''
+
+        if not self.enabled:
+            yield
+            return
+
+        self.stack.append(name)
+        rec = self.record('.'.join(self.stack))
+
+        prof = None
+        if self.cprofile and len(self.stack) == 1:
+            prof = self.profiles.setdefault(name, cProfile.Profile())
+            prof.enable()
+
+        wall = time.perf_counter()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = cpu_time() - cpu
+            if prof is not None:
+                prof.disable()
+            self.stack.pop()
+
+            rec['calls'] += 1
+            rec['wall_s'] += wall
+            rec['cpu_s'] += cpu
+            rec['peak_rss_mb'] = max(rec['peak_rss_mb'], peak_rss())
+
+    def record(self, path):
+        '''
+        Get the record of a stage
+        '''
+
+        return self.stages.setdefault(path, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'peak_rss_mb': 0.0, 'rows': {}})
+
+    def count(self, key, n):
+        '''
+        Add to a row count of the current stage
+        '''
+
+        if not self.enabled or len(self.stack) == 0:
+            return
+
+        rec = self.record('.'.join(self.stack))
+        rec['rows'][key] = rec['rows'].get(key, 0) + int(n)
+
+    def write(self):
+        '''
+        Write all stages to timings.json in the output directory,
+        and the cProfile statistics of each top-level stage to profile_<stage>.prof
+        '''
+
+        if not self.enabled or not os.path.isdir(self.out):
+            return
+
+        report = {'wall_s': round(time.perf_counter() - self.start, 3),
+                  'cpu_s': round(cpu_time(), 3),
+                  'peak_rss_mb': round(peak_rss(), 1),
+                  'stages': {}}
+        for path, rec in self.stages.items():
+            report['stages'][path] = dict(rec, wall_s=round(rec['wall_s'], 3), cpu_s=round(rec['cpu_s'], 3),
+                                          peak_rss_mb=round(rec['peak_rss_mb'], 1))
+
+        with open(self.out+'timings.json', 'w') as f:
+            json.dump(report, f, indent=2)
+
+        for name, prof in self.profiles.items():
+            prof.dump_stats(self.out+'profile_{}.prof'.format(name))
+
+def cpu_time():
+    '''
+    CPU time of this process and its finished child processes
+    '''
+
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+def peak_rss():
+    '''
+    Peak RSS in MB of this process or of the largest finished child process
+    '''
+
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/1024
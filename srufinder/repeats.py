@@ -0,0 +1,306 @@
+import os
+import hashlib
+import functools
+import logging
+
+import numpy as np
+import pandas as pd
+
+from srufinder import kmer
+from srufinder.sequences import Fasta, ranges, write_fasta
+
+# Prebuilt table of all repeats and the representative repeats, in the database directory
+ARTIFACT = 'repeats.npz'
+REPRESENTATIVES = 'repeats_rep.fa'
+
+# Pairs of hits and members rescored at a time
+EXPAND_PAIRS = 1 << 15
+
+def file_hash(path):
+    '''
+    Hash the content of a file
+    '''
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def orient(codes, lengths, flip):
+    '''
+    Reverse complement the first lengths codes of the flipped rows of a matrix of base codes
+    '''
+
+    cols = np.arange(codes.shape[1])
+    src = np.where(flip[:, None] & (cols < lengths[:, None]), lengths[:, None] - 1 - cols, cols)
+    codes = np.take_along_axis(codes, src, axis=1)
+
+    return np.where(flip[:, None] & (codes < 4), 3 - codes, codes)
+
+def compact(db, identity=90):
+    '''
+    Cluster repeats of the same subtype and length with at least identity % ungapped identity,
+    in either orientation, and write the representative of each cluster to repeats_rep.fa.
+    The first repeat of a cluster in database order is its representative.
+    All repeats are saved in repeats.npz with their lengths, subtypes, sequences, and representatives.
+    Return the number of repeats and representatives
+    '''
+
+    repeatdb = os.path.join(db, 'repeats.fa')
+    fasta = Fasta(repeatdb)
+    names = fasta.names()
+    seqs = [fasta[x].upper() for x in names]
+
+    lengths = np.array([len(x) for x in seqs], dtype=np.int32)
+    subtypes = np.array([x.split(':')[0] for x in names])
+    codes = np.full((len(seqs), lengths.max()), kmer.SEP, dtype=np.uint8)
+    for i, x in enumerate(seqs):
+        codes[i, :len(x)] = kmer.encode(x)
+
+    rep = np.arange(len(seqs), dtype=np.int32)
+    flipped = np.zeros(len(seqs), dtype=np.int8)
+
+    groups = pd.DataFrame({'Subtype': subtypes, 'Length': lengths}).groupby(['Subtype', 'Length'], sort=False).indices
+    for (_, length), ind in groups.items():
+        if len(ind) == 1:
+            continue
+
+        fwd = codes[ind, :length]
+        rev = np.array([kmer.revcomp(x) for x in fwd])
+        left = np.ones(len(ind), dtype=bool)
+
+        # Greedily take the first repeat left as representative of all repeats left similar to it
+        for j in range(len(ind)):
+            if not left[j]:
+                continue
+            same = ((fwd == fwd[j]) & (fwd < 4)).sum(axis=1)
+            opposite = ((rev == fwd[j]) & (rev < 4)).sum(axis=1)
+            members = left & (np.maximum(same, opposite)*100 >= identity*length)
+            rep[ind[members]] = ind[j]
+            flipped[ind[members]] = opposite[members] > same[members]
+            left &= ~members
+
+    reps = np.unique(rep)
+    with open(os.path.join(db, REPRESENTATIVES), 'w') as out_file:
+        for i in reps:
+            write_fasta(out_file, fasta.header(names[i]), seqs[i])
+
+    np.savez(os.path.join(db, ARTIFACT),
+             names=np.array(names), lengths=lengths, subtypes=subtypes, codes=codes,
+             rep=rep, orient=flipped, identity=np.float64(identity), source=np.array(file_hash(repeatdb)))
+
+    return len(names), len(reps)
+
+@functools.lru_cache(maxsize=4)
+def load(db):
+    '''
+    Load the prebuilt repeat table of a database directory, once per process.
+    Return None if there is none, or if the repeat database changed since it was built
+    '''
+
+    path = os.path.join(db, ARTIFACT)
+    if not os.path.isfile(path):
+        return None
+
+    repeats = RepeatDB(path)
+    if repeats.source != file_hash(os.path.join(db, 'repeats.fa')):
+        logging.warning('{} is older than repeats.fa and is not used. Rerun srufinder-compact'.format(path))
+        return None
+
+    return repeats
+
+class RepeatDB(object):
+    '''
+    All repeats of the database with their lengths, subtypes, and sequences,
+    and the representative each repeat was clustered with
+    '''
+
+    def __init__(self, path):
+
+        with np.load(path) as npz:
+            self.names = npz['names'].astype(object)
+            self.lengths = npz['lengths']
+            self.subtypes = npz['subtypes'].astype(object)
+            self.codes = npz['codes']
+            self.rep = npz['rep']
+            self.orient = npz['orient']
+            self.identity = float(npz['identity'])
+            self.source = str(npz['source'])
+
+        self.querydb = os.path.join(os.path.dirname(path), REPRESENTATIVES)
+        self.index = pd.Index(self.names)
+        self.len_df = pd.DataFrame({'Repeat_len': self.lengths}, index=self.index)
+
+        # Members of each representative, in database order
+        self.members = np.argsort(self.rep, kind='mergesort').astype(np.int32)
+        self.n_members = np.bincount(self.rep, minlength=len(self.rep))
+        self.first = np.concatenate(([0], np.cumsum(self.n_members)[:-1]))
+        self.compacted = (self.n_members > 1).any()
+        self.dist = self.distances()
+
+    def expandable(self, hits):
+        '''
+        Get the index of the repeat of each hit,
+        and the rows of ungapped hits of representatives with other members
+        '''
+
+        idx = self.index.get_indexer(hits['Repeat'].astype(str))
+        aln = hits['Alignment'].values
+        ungapped = ((hits['Gaps'].values == 0) &
+                    (hits['Repeat_end'].values - hits['Repeat_start'].values + 1 == aln) &
+                    (np.abs(hits['Acc_end'].values - hits['Acc_start'].values) + 1 == aln))
+        sel = np.nonzero((idx >= 0) & ungapped)[0]
+
+        return idx, sel[self.n_members[idx[sel]] > 1]
+
+    def windows(self, hits, rows, length, sequences):
+        '''
+        Get the base codes on the diagonal of each hit over the full length of its repeat,
+        in the orientation of the repeat, with positions beyond the sequence as separators.
+        Return the codes and the sequence position of the first base of each window
+        '''
+
+        length = length.astype(np.int64)
+        rs = hits['Repeat_start'].values[rows].astype(np.int64)
+        a_s = hits['Acc_start'].values[rows].astype(np.int64)
+        a_e = hits['Acc_end'].values[rows].astype(np.int64)
+        reverse = a_s > a_e
+        start = np.where(reverse, np.maximum(a_s, a_e) + rs - 1 - length, np.minimum(a_s, a_e) - rs)
+
+        seqs = sequences.extract(hits['Acc'].astype(str).values[rows], start, start + length)
+        size = np.array([len(x) for x in seqs], dtype=np.int64)
+        width = self.codes.shape[1]
+        fill = np.arange(len(rows))*width + np.maximum(-start, 0)
+        codes = np.full((len(rows), width), kmer.SEP, dtype=np.uint8)
+        codes.reshape(-1)[ranges(fill, fill + size)] = kmer.encode(''.join(seqs))
+
+        return orient(codes, length, reverse), start
+
+    def distances(self):
+        '''
+        Get the largest number of positions at which a member of each representative,
+        in the orientation of the representative, differs from it or is ambiguous
+        '''
+
+        member = orient(self.codes, self.lengths, self.orient == 1)
+        rep = self.codes[self.rep]
+        differ = ((member != rep) | (rep > 3)) & (np.arange(self.codes.shape[1]) < self.lengths[:, None])
+        dist = np.zeros(len(self.rep), dtype=np.int64)
+        np.maximum.at(dist, self.rep, differ.sum(axis=1))
+
+        return dist
+
+    def reachable(self, hits, sequences, passes, identity, coverage):
+        '''
+        Get the hits that pass the identity and coverage cutoffs, or that may pass them after expansion.
+        A member matches the sequence at most at the positions the representative matches
+        and the positions where they differ, so hits of representatives are kept
+        only if the matches of the representative over the full repeat make that possible
+        '''
+
+        keep = passes.copy()
+        idx, sel = self.expandable(hits)
+        sel = sel[~passes[sel]]
+        if len(sel) == 0:
+            return keep
+
+        for rows in np.array_split(sel, np.arange(EXPAND_PAIRS, len(sel), EXPAND_PAIRS)):
+            g, _ = self.windows(hits, rows, self.lengths[idx[rows]], sequences)
+            q = self.codes[idx[rows]]
+            matches = ((g == q) & (q < 4)).sum(axis=1) + self.dist[idx[rows]]
+            # One match of slack for the rounding of identities
+            keep[rows] = matches >= identity*coverage/1e4*self.lengths[idx[rows]] - 1
+
+        return keep
+
+    def expand(self, hits, sequences):
+        '''
+        Replace each ungapped hit of a representative by the hit of the best matching member
+        of its cluster at the same position, rescoring the members against the sequences.
+        Hits are expanded in batches of a bounded number of pairs of hits and members.
+        Gapped hits keep the representative
+        '''
+
+        idx, sel = self.expandable(hits)
+        if len(sel) == 0:
+            return hits
+
+        # Batches of consecutive hits with up to EXPAND_PAIRS members in total, or a single hit
+        cnt = self.n_members[idx[sel]]
+        batch = (np.cumsum(cnt) - cnt)//EXPAND_PAIRS
+        bounds = np.append(np.nonzero(np.diff(batch, prepend=-1))[0], len(sel))
+
+        new = [self.expand_batch(hits, idx, sel[bounds[i]:bounds[i+1]], sequences) for i in range(len(bounds)-1)]
+        new = [x for x in new if x is not None]
+        if len(new) == 0:
+            return hits
+
+        hit = np.concatenate([x[0] for x in new])
+        hits = hits.copy()
+        for col in new[0][1]:
+            values = np.concatenate([x[1][col] for x in new])
+            if col != 'Repeat':
+                values = values.astype(hits[col].dtype)
+            hits.iloc[hit, hits.columns.get_loc(col)] = values
+
+        return hits
+
+    def expand_batch(self, hits, idx, sel, sequences):
+        '''
+        Rescore the members of the representative of a batch of hits.
+        Return the rows of the hits with a better member and their new values,
+        or None if the representative is best for all hits
+        '''
+
+        # Pairs of hits and members of their representative
+        cnt = self.n_members[idx[sel]]
+        pair = np.repeat(np.arange(len(sel)), cnt)
+        row = sel[pair]
+        within = np.arange(cnt.sum()) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        member = self.members[np.repeat(self.first[idx[sel]], cnt) + within]
+
+        # Sequence on the diagonal of each hit, in the orientation of each member
+        g, start = self.windows(hits, sel, self.lengths[idx[sel]], sequences)
+        length = self.lengths[member].astype(np.int64)
+        opposite = self.orient[member] == 1
+        g = orient(g[pair], length, opposite)
+
+        # Best ungapped segment of each member on the diagonal, as found by the k-mer matcher
+        q = self.codes[member]
+        scores = np.where((g == q) & (q < 4), kmer.REWARD, kmer.PENALTY)
+        scores[g == kmer.SEP] = kmer.BARRIER
+        qfrom, qto, raw = kmer.max_segment(scores)
+
+        # Best member of each hit, the representative on ties
+        order = np.lexsort((within, -raw, row))
+        best = order[np.concatenate(([True], row[order][1:] != row[order][:-1]))]
+        best = best[member[best] != idx[row[best]]]
+        if len(best) == 0:
+            return None
+
+        hit = row[best]
+        aln = qto[best] - qfrom[best]
+        mism = aln - (raw[best] - kmer.PENALTY*aln)//(kmer.REWARD - kmer.PENALTY)
+
+        # Sequence positions of the ends of the segments
+        forward = (hits['Acc_start'].values[hit] <= hits['Acc_end'].values[hit]) ^ opposite[best]
+        first = np.where(forward, qfrom[best], length[best] - 1 - qfrom[best])
+        last = np.where(forward, qto[best] - 1, length[best] - qto[best])
+        window = start[pair[best]]
+
+        # Scores relative to the score of the representative, keeping the calibration of the search
+        raw_rep = hits['Alignment'].values[hit] - (kmer.REWARD - kmer.PENALTY)*hits['Mismatches'].values[hit]
+        calibration = hits['Score'].values[hit] - np.round(kmer.bitscore(raw_rep), 1)
+
+        return hit, {'Repeat': self.names[member[best]],
+                     'Identity': np.round((aln - mism)/aln*100, 3),
+                     'Alignment': aln,
+                     'Mismatches': mism,
+                     'Repeat_start': qfrom[best] + 1,
+                     'Repeat_end': qto[best],
+                     'Acc_start': window + first + 1,
+                     'Acc_end': window + last + 1,
+                     'Evalue': hits['Evalue'].values[hit]*np.exp(-kmer.LAMBDA*(raw[best] - raw_rep)),
+                     'Score': np.round(np.round(kmer.bitscore(raw[best]), 1) + calibration, 1)}
@@ -0,0 +1,467 @@
+import mmap
+import heapq
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+# Bytes scanned at a time when indexing a sequence
+CHUNK = 1 << 26
+
+# Bases packed in 2 bits, where other characters than ACGT are coded 4
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+PACK = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate(BASES):
+    PACK[base] = i
+
+# Bases of each packed byte, with the first base in the lowest bits
+UNPACK = BASES[(np.arange(256)[:, None] >> np.array([0, 2, 4, 6])) & 3]
+
+def write_fasta(handle, header, seq, width=60):
+    '''
+    Write a single fasta record with wrapped sequence lines
+    '''
+
+    handle.write('>{}\n'.format(header))
+    for i in range(0, len(seq), width):
+        handle.write(seq[i:i+width]+'\n')
+
+def pipe_fasta(cmd, records, stdout):
+    '''
+    Run a command on (name, header, sequence) records fed through a pipe as fasta
+    '''
+
+    proc = subprocess.Popen(cmd,
+                            stdin=subprocess.PIPE,
+                            stdout=stdout,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True)
+    try:
+        for name, header, seq in records:
+            write_fasta(proc.stdin, header, seq)
+        proc.stdin.close()
+    except BrokenPipeError:
+        # The command failed, which is caught by the check of its output
+        pass
+    finally:
+        if not proc.stdin.closed:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        proc.wait()
+
+def parse_fasta(lines):
+    '''
+    Iterate over (header, sequence) of fasta records from lines of text
+    '''
+
+    header = None
+    seq = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(seq)
+            header = line[1:]
+            seq = []
+        elif line != '':
+            if header is None:
+                raise ValueError('Input does not look like a fasta file')
+            seq.append(line)
+
+    if header is not None:
+        yield header, ''.join(seq)
+
+def balance(sequences, n):
+    '''
+    Split the sequences in at most n shards of similar total length,
+    by adding the longest sequences first to the shortest shard.
+    Sequences are in input order within each shard
+    '''
+
+    names = sequences.names()
+    order = sorted(range(len(names)), key=lambda i: sequences.length(names[i]), reverse=True)
+
+    shards = [[] for _ in range(n)]
+    sizes = [(0, i) for i in range(n)]
+    for i in order:
+        size, ind = heapq.heappop(sizes)
+        shards[ind].append(i)
+        heapq.heappush(sizes, (size + sequences.length(names[i]), ind))
+
+    return [[names[i] for i in sorted(x)] for x in shards if len(x) > 0]
+
+def clip(lengths, starts, ends):
+    '''
+    Clip windows from 0-based start to end (exclusive) to sequences of the given lengths
+    '''
+
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, lengths)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), starts, lengths)
+
+    return starts, ends
+
+def ranges(starts, ends):
+    '''
+    Concatenate the positions of ranges from start to end (exclusive)
+    '''
+
+    size = ends - starts
+
+    return np.arange(size.sum()) + np.repeat(starts - (np.cumsum(size) - size), size)
+
+def split(buf, starts, ends):
+    '''
+    Split a buffer of characters in sequences from start to end (exclusive)
+    '''
+
+    text = buf.tobytes().decode()
+
+    return [text[x:y] for x, y in zip(starts.tolist(), ends.tolist())]
+
+def runs(values, mask):
+    '''
+    Get start, end (exclusive), and value of the runs of equal values where mask is True
+    '''
+
+    key = np.where(mask, values.astype(np.int16), -1)
+    if len(key) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+
+    bounds = np.flatnonzero(key[1:] != key[:-1]) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(key)]))
+    keep = key[starts] >= 0
+
+    return starts[keep], ends[keep], key[starts[keep]].astype(np.uint8)
+
+def pack(raw, offset, parts):
+    '''
+    Pack bytes of sequences padded to a multiple of 4 bases, which start at offset,
+    and append the packed bytes, the runs of lowercase, and the runs of other characters than ACGT to parts
+    '''
+
+    raw = np.frombuffer(raw, dtype=np.uint8)
+    for i in range(0, len(raw), CHUNK):
+        chunk = raw[i:i+CHUNK]
+        is_lower = (chunk >= ord('a')) & (chunk <= ord('z'))
+        upper = np.where(is_lower, chunk - 32, chunk).astype(np.uint8)
+        codes = PACK[upper]
+
+        start, end, _ = runs(is_lower, is_lower)
+        parts[1].append(start + offset + i)
+        parts[2].append(end + offset + i)
+        start, end, value = runs(upper, codes > 3)
+        parts[3].append(start + offset + i)
+        parts[4].append(end + offset + i)
+        parts[5].append(value)
+
+        codes = (codes & 3).reshape(-1, 4)
+        parts[0].append(codes[:, 0] | codes[:, 1] << 2 | codes[:, 2] << 4 | codes[:, 3] << 6)
+
+class Fasta(object):
+    '''
+    A faidx-style index of a fasta file with random access to the sequences
+    through a memory map, such that only the requested bytes are read.
+    Records where the lines are not of equal width can not be indexed
+    and are kept in memory instead
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        self.index = {}
+        self.inmem = {}
+
+        with open(path, 'rb') as handle:
+            try:
+                self.mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError('Empty fasta file')
+
+        self.build()
+
+    def build(self):
+        '''
+        Index the fasta by recording for each record the header,
+        the sequence length, the offset of the sequence, the bases per line,
+        and the bytes per line
+        '''
+
+        mm = self.mm
+        pos = 0
+        while pos < len(mm) and mm[pos:pos+1].isspace():
+            pos += 1
+        if mm[pos:pos+1] != b'>':
+            raise ValueError('Input does not look like a fasta file')
+
+        while pos < len(mm):
+            head_end = mm.find(b'\n', pos)
+            if head_end == -1:
+                head_end = len(mm)
+            header = mm[pos+1:head_end].decode().strip()
+            name = header.split()[0] if header else ''
+            if name == '':
+                raise ValueError('Empty fasta header')
+            if name in self.index:
+                raise ValueError('Duplicate fasta header: {}'.format(name))
+
+            seq_start = min(head_end+1, len(mm))
+            nxt = mm.find(b'\n>', head_end)
+            seq_end = len(mm) if nxt == -1 else nxt+1
+
+            self.index[name] = (header,) + self.scan(name, seq_start, seq_end)
+            pos = seq_end
+
+        if len(self.index) == 0:
+            raise ValueError('No sequences in fasta file')
+
+        # Layout of the sequences as arrays for bulk extraction
+        self.table = pd.Index(list(self.index))
+        self.layout = np.array([x[1:] for x in self.index.values()], dtype=np.int64).reshape(-1, 4)
+        self.irregular = self.table.isin(list(self.inmem))
+
+    def scan(self, name, start, end):
+        '''
+        Get length, offset, bases per line, and bytes per line
+        of the sequence between two byte offsets
+        '''
+
+        first = self.mm.find(b'\n', start, end)
+        if first == -1:
+            line = self.mm[start:end].rstrip()
+            return (len(line), start, len(line), end-start)
+
+        linewidth = first - start + 1
+        linebases = len(self.mm[start:first+1].rstrip())
+        body = np.frombuffer(self.mm, dtype=np.uint8, count=end-start, offset=start)
+
+        # Lines of equal width have line breaks only at fixed positions
+        nfull = len(body) // linewidth
+        regular = linebases > 0 and bool(np.all(body[linewidth-1:nfull*linewidth:linewidth] == 10))
+        newlines = 0
+        for i in range(0, nfull*linewidth, CHUNK):
+            newlines += int(np.count_nonzero(body[i:min(i+CHUNK, nfull*linewidth)] == 10))
+        last = bytes(body[nfull*linewidth:])
+        if last.endswith(b'\n'):
+            last = last[:-1]
+        if last.endswith(b'\r'):
+            last = last[:-1]
+        regular = regular and newlines == nfull and last == b''.join(last.split())
+
+        if regular:
+            return (nfull*linebases+len(last), start, linebases, linewidth)
+
+        # Fall back to keeping the sequence in memory
+        self.inmem[name] = b''.join(bytes(body).split())
+        return (len(self.inmem[name]), start, 0, 0)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return list(self.index)
+
+    def header(self, name):
+        return self.index[name][0]
+
+    def length(self, name):
+        return self.index[name][1]
+
+    def fetch(self, name, start, end):
+        '''
+        Return the sequence from 0-based start to end (exclusive)
+        '''
+
+        _, length, offset, linebases, linewidth = self.index[name]
+        start = max(start, 0)
+        end = min(end, length)
+        if end <= start:
+            return ''
+
+        if name in self.inmem:
+            return self.inmem[name][start:end].decode()
+
+        byte_start = offset + start // linebases * linewidth + start % linebases
+        byte_end = offset + end // linebases * linewidth + end % linebases
+        raw = self.mm[byte_start:byte_end]
+        if linewidth > linebases:
+            raw = raw.replace(b'\n', b'').replace(b'\r', b'')
+
+        return raw.decode()
+
+    def extract(self, names, starts, ends):
+        '''
+        Return the sequences of many windows from 0-based start to end (exclusive) at once,
+        gathering the bytes of all windows from the memory map in one go
+        '''
+
+        ind = self.table.get_indexer(names)
+        if (ind < 0).any():
+            raise KeyError(np.asarray(names)[ind < 0][0])
+
+        length, offset, linebases, linewidth = self.layout[ind].T
+        starts, ends = clip(length, starts, ends)
+
+        # Byte ranges of the windows, without the line breaks.
+        # Sequences with lines of unequal width are in memory and have no byte range
+        inmem = self.irregular[ind]
+        linebases = np.maximum(linebases, 1)
+        raw = np.frombuffer(self.mm, dtype=np.uint8)[ranges(offset + starts // linebases * linewidth + starts % linebases,
+                                                            offset + ends // linebases * linewidth + ends % linebases)]
+        if (linewidth > linebases).any():
+            raw = raw[(raw != ord('\n')) & (raw != ord('\r'))]
+
+        size = np.where(inmem, 0, ends - starts)
+        seqs = split(raw, np.cumsum(size) - size, np.cumsum(size))
+
+        for i in np.flatnonzero(inmem):
+            seqs[i] = self.inmem[self.table[ind[i]]][starts[i]:ends[i]].decode()
+
+        return seqs
+
+    def __getitem__(self, name):
+        return self.fetch(name, 0, self.length(name))
+
+    def records(self, names=None):
+        '''
+        Iterate over (name, header, sequence) of all records, or of the given records
+        '''
+
+        for name in (self.index if names is None else names):
+            yield name, self.header(name), self[name]
+
+class Genome(object):
+    '''
+    In-memory sequences with the same interface as Fasta, packed in 2 bits per base.
+    Runs of lowercase bases and runs of other characters than ACGT are kept aside,
+    such that the sequences are returned as given
+    '''
+
+    def __init__(self, records):
+
+        self.index = {}
+        parts = ([], [], [], [], [], [])
+        pending = []
+        size = 0
+        offset = 0
+        for header, seq in records:
+            header = header.strip()
+            name = header.split()[0] if header else ''
+            if name == '':
+                raise ValueError('Empty fasta header')
+            if name in self.index:
+                raise ValueError('Duplicate fasta header: {}'.format(name))
+
+            raw = str(seq).encode()
+            self.index[name] = (header, len(raw), offset + size)
+
+            # Sequences start at a byte boundary, and are packed once CHUNK bases are pending
+            pending += [raw, b'A'*(-len(raw) % 4)]
+            size += len(raw) + (-len(raw) % 4)
+            if size >= CHUNK:
+                pack(b''.join(pending), offset, parts)
+                pending = []
+                offset += size
+                size = 0
+
+        if len(self.index) == 0:
+            raise ValueError('No sequences')
+
+        pack(b''.join(pending), offset, parts)
+        self.packed = np.concatenate(parts[0]) if len(parts[0]) > 0 else np.zeros(0, dtype=np.uint8)
+        self.lower = [np.concatenate(x) if len(x) > 0 else np.zeros(0, dtype=np.int64) for x in parts[1:3]]
+        self.other = [np.concatenate(x) if len(x) > 0 else np.zeros(0, dtype=np.int64) for x in parts[3:]]
+
+        self.table = pd.Index(list(self.index))
+        self.layout = np.array([x[1:] for x in self.index.values()], dtype=np.int64).reshape(-1, 2)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def names(self):
+        return list(self.index)
+
+    def header(self, name):
+        return self.index[name][0]
+
+    def length(self, name):
+        return self.index[name][1]
+
+    def extract(self, names, starts, ends):
+        '''
+        Return the sequences of many windows from 0-based start to end (exclusive) at once
+        '''
+
+        ind = self.table.get_indexer(names)
+        if (ind < 0).any():
+            raise KeyError(np.asarray(names)[ind < 0][0])
+
+        return self.unpack(ind, starts, ends)
+
+    def unpack(self, ind, starts, ends):
+        '''
+        Unpack windows on the sequences of the given indices
+        '''
+
+        length, offset = self.layout[ind].T
+        starts, ends = clip(length, starts, ends)
+        starts += offset
+        ends += offset
+
+        # Unpack the bytes of all windows, with each window starting within its first byte
+        first = starts >> 2
+        n = ((ends + 3) >> 2) - first
+        buf = UNPACK[self.packed[ranges(first, first + n)]].ravel()
+        begin = 4*(np.cumsum(n) - n) + (starts & 3)
+
+        # Restore the runs of other characters, then the runs of lowercase, overlapping the windows
+        for run_start, run_end, value in (self.other, self.lower + [None]):
+            lo = np.searchsorted(run_end, starts, side='right')
+            hi = np.maximum(np.searchsorted(run_start, ends, side='left'), lo)
+            win = np.repeat(np.arange(len(lo)), hi - lo)
+            run = ranges(lo, hi)
+            x = np.maximum(run_start[run], starts[win]) - starts[win] + begin[win]
+            y = np.minimum(run_end[run], ends[win]) - starts[win] + begin[win]
+            pos = ranges(x, y)
+            if value is None:
+                buf[pos] |= 32
+            else:
+                buf[pos] = value[np.repeat(run, y - x)]
+
+        return split(buf, begin, begin + ends - starts)
+
+    def fetch(self, name, start, end):
+        '''
+        Return the sequence from 0-based start to end (exclusive)
+        '''
+
+        return self.unpack([self.table.get_loc(name)], [start], [end])[0]
+
+    def __getitem__(self, name):
+        return self.fetch(name, 0, self.length(name))
+
+    def records(self, names=None):
+        '''
+        Iterate over (name, header, sequence) of all records, or of the given records,
+        unpacking consecutive records of up to CHUNK bases at once
+        '''
+
+        names = self.names() if names is None else list(names)
+        ind = self.table.get_indexer(names)
+        if (ind < 0).any():
+            raise KeyError(np.asarray(names)[ind < 0][0])
+
+        length = self.layout[ind, 0]
+        batch = (np.cumsum(length) - length) // CHUNK
+        bounds = np.append(np.flatnonzero(np.diff(batch, prepend=-1)), len(ind))
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            for name, seq in zip(names[i:j], self.unpack(ind[i:j], np.zeros(j-i, dtype=np.int64), length[i:j])):
+                yield name, self.header(name), seq
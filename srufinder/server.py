@@ -0,0 +1,207 @@
+import os
+import json
+import logging
+import argparse
+import threading
+import traceback
+import socketserver
+import multiprocessing
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+from srufinder import api
+from srufinder import kmer
+from srufinder import repeats
+from srufinder.arguments import add_options
+from srufinder.errors import SRUFinderError
+from srufinder.sequences import parse_fasta
+
+def _init_worker(repeatdb, querydb, kmer_size):
+    '''
+    Load the repeat table, the repeat lengths, and the k-mer index once in each worker process
+    '''
+
+    repeats.load(os.path.dirname(repeatdb))
+    api.repeat_lengths(repeatdb)
+    kmer.load_index(querydb, kmer_size)
+
+def _run_job(text, params):
+    '''
+    Run a job in a worker process and return the HTTP status and the JSON response
+    '''
+
+    try:
+        result = api.find(parse_fasta(text.splitlines()), **params)
+    except (SRUFinderError, TypeError) as e:
+        return 400, json.dumps({'error': str(e)})
+    except Exception:
+        logging.error('Job failed:\n{}'.format(traceback.format_exc()))
+        return 500, json.dumps({'error': 'Job failed'})
+
+    return 200, '{{"srus": {}, "arrays": {}, "spacers": {}}}'.format(
+        result.srus.to_json(orient='records'),
+        result.arrays.to_json(orient='records'),
+        result.spacers.to_json(orient='records'))
+
+def parse_params(query):
+    '''
+    Convert the parameters of a query string to the types of the command line options.
+    Flags are set by true, yes, or 1
+    '''
+
+    ap = argparse.ArgumentParser(add_help=False)
+    add_options(ap)
+    defaults = vars(ap.parse_args([]))
+
+    params = {}
+    for k, v in parse_qsl(query, keep_blank_values=True):
+        if k not in defaults:
+            raise SRUFinderError('Unknown parameter {}'.format(k))
+        if isinstance(defaults[k], bool):
+            params[k] = v.lower() in ('', '1', 'true', 'yes')
+        else:
+            try:
+                params[k] = getattr(ap.parse_args(['--'+k, v]), k)
+            except SystemExit:
+                raise SRUFinderError('Bad value for parameter {}: {}'.format(k, v))
+
+    return params
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    GET /health reports the workers and the jobs in progress.
+    POST /find with a fasta as body and parameters in the query string runs a job
+    and returns the SRUs, arrays, and spacers as JSON
+    '''
+
+    def address_string(self):
+        # Clients of Unix sockets have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logging.debug('{} {}'.format(self.address_string(), format % args))
+
+    def reply(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/health':
+            return self.reply(404, json.dumps({'error': 'Not found'}))
+
+        self.reply(200, json.dumps({'workers': self.server.workers,
+                                    'queue': self.server.queue,
+                                    'jobs': self.server.jobs}))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/find':
+            return self.reply(404, json.dumps({'error': 'Not found'}))
+
+        try:
+            params = parse_params(url.query)
+        except SRUFinderError as e:
+            return self.reply(400, json.dumps({'error': str(e)}))
+        params.setdefault('db', self.server.db)
+
+        length = int(self.headers.get('Content-Length', 0))
+        if length > self.server.max_bytes:
+            return self.reply(413, json.dumps({'error': 'Input larger than {} bytes'.format(self.server.max_bytes)}))
+        try:
+            text = self.rfile.read(length).decode()
+        except UnicodeDecodeError:
+            return self.reply(400, json.dumps({'error': 'Input is not a fasta in text'}))
+
+        # Refuse jobs when all workers are busy and the queue is full
+        if not self.server.slots.acquire(blocking=False):
+            return self.reply(503, json.dumps({'error': 'Queue is full'}))
+
+        # The slot is held until the job finishes, also if the client is answered with a timeout,
+        # as the job keeps its worker until then
+        def release(result):
+            with self.server.lock:
+                self.server.jobs -= 1
+            self.server.slots.release()
+
+        with self.server.lock:
+            self.server.jobs += 1
+        try:
+            job = self.server.pool.apply_async(_run_job, (text, params), callback=release, error_callback=release)
+        except Exception:
+            release(None)
+            raise
+
+        try:
+            status, body = job.get(self.server.job_timeout)
+        except multiprocessing.TimeoutError:
+            status, body = 504, json.dumps({'error': 'Job timed out'})
+
+        self.reply(status, body)
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class Server(object):
+    '''
+    Serve jobs over HTTP on a local port or a Unix socket,
+    with a pool of worker processes kept warm with the repeat database
+    '''
+
+    def __init__(self, args):
+
+        logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=args.log_lvl)
+
+        self.args = args
+        self.db = args.db if args.db != '' else os.environ.get('SRUFINDER_DB', '')
+        if self.db == '':
+            raise SRUFinderError('Could not find database directory')
+        self.repeatdb = os.path.join(self.db, 'repeats.fa')
+        if not os.path.isfile(self.repeatdb):
+            raise SRUFinderError('Could not find repeat database '+self.repeatdb)
+
+        # Jobs only search the representative repeats if the database has been compacted
+        prebuilt = repeats.load(os.path.dirname(self.repeatdb))
+        self.querydb = prebuilt.querydb if prebuilt is not None and prebuilt.compacted else self.repeatdb
+
+    def run(self):
+        '''
+        Start the workers and serve until interrupted
+        '''
+
+        if self.args.socket is not None:
+            if os.path.exists(self.args.socket):
+                os.remove(self.args.socket)
+            httpd = ThreadingUnixHTTPServer(self.args.socket, Handler)
+            where = 'socket '+self.args.socket
+        else:
+            httpd = ThreadingHTTPServer((self.args.host, self.args.port), Handler)
+            where = 'http://{}:{}'.format(self.args.host, self.args.port)
+
+        httpd.workers = self.args.workers
+        httpd.queue = self.args.queue
+        httpd.job_timeout = self.args.timeout
+        httpd.db = self.db
+        httpd.max_bytes = int(self.args.max_mb*1e6)
+        httpd.jobs = 0
+        httpd.lock = threading.Lock()
+        httpd.slots = threading.BoundedSemaphore(self.args.workers + self.args.queue)
+
+        logging.info('Starting {} worker(s)'.format(self.args.workers))
+        httpd.pool = multiprocessing.Pool(self.args.workers, initializer=_init_worker,
+                                          initargs=(self.repeatdb, self.querydb, self.args.kmer_size))
+
+        logging.info('Serving on {}'.format(where))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            httpd.pool.terminate()
+            if self.args.socket is not None and os.path.exists(self.args.socket):
+                os.remove(self.args.socket)
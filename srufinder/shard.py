@@ -0,0 +1,185 @@
+import os
+import gzip
+import logging
+import subprocess
+
+import pandas as pd
+
+from srufinder import workflow
+from srufinder.controller import Controller, GZIP_MAGIC
+from srufinder.blast import Blast
+from srufinder.sequences import Fasta, Genome, parse_fasta, write_fasta, balance
+from srufinder.errors import SRUFinderError
+
+def shard_dir(split_dir, i):
+    return split_dir+'shard_{}/'.format(i)
+
+def shard_fasta(split_dir, i):
+    return split_dir+'shard_{}.fna'.format(i)
+
+def shard_done(split_dir, i):
+    return shard_dir(split_dir, i)+'shard.done'
+
+class Split(object):
+    '''
+    Split an input fasta by contig in shards of similar total length,
+    which can be run as separate processes or on separate nodes and merged afterwards.
+    In single mode a prodigal model is trained on the whole input and used for all shards
+    '''
+
+    def __init__(self, args):
+
+        logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=args.log_lvl)
+
+        self.fasta = args.input
+        self.out = os.path.join(args.output, '')
+        self.n = args.shards
+        self.prod = args.prodigal
+
+        if not os.path.isfile(self.fasta):
+            raise SRUFinderError('Could not find input file')
+
+        try:
+            with open(self.fasta, 'rb') as handle:
+                compressed = handle.read(2) == GZIP_MAGIC
+            if compressed:
+                with gzip.open(self.fasta, 'rt') as handle:
+                    self.sequences = Genome(parse_fasta(handle))
+            else:
+                self.sequences = Fasta(self.fasta)
+        except (ValueError, OSError, EOFError):
+            raise SRUFinderError('Input file is in bad format')
+
+        try:
+            os.mkdir(self.out)
+        except FileExistsError:
+            raise SRUFinderError('Directory '+self.out+' already exists')
+
+    def run(self):
+        '''
+        Write the shards, the table of shards, and the prodigal model
+        '''
+
+        shards = balance(self.sequences, self.n)
+
+        logging.info('Writing {} shards'.format(len(shards)))
+
+        rows = []
+        for i, names in enumerate(shards, 1):
+            with open(shard_fasta(self.out, i), 'w') as out_file:
+                for _, header, seq in self.sequences.records(names):
+                    write_fasta(out_file, header, seq)
+            rows.append((i, len(names), sum(self.sequences.length(x) for x in names)))
+
+        pd.DataFrame(rows, columns=['Shard', 'Contigs', 'Bp']).to_csv(self.out+'shards.tab', index=False, sep='\t')
+
+        if self.prod == 'single':
+            logging.info('Training prodigal on the whole input')
+            self.train(self.out+'prodigal.trn')
+
+        logging.info('Done')
+
+    def train(self, training):
+        '''
+        Train a prodigal model on the whole input, fed through a pipe
+        '''
+
+        prodigal = subprocess.Popen(['prodigal', '-p', 'single', '-t', training],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.DEVNULL,
+                                    universal_newlines=True)
+        try:
+            for name, header, seq in self.sequences.records():
+                write_fasta(prodigal.stdin, header, seq)
+            prodigal.stdin.close()
+        except BrokenPipeError:
+            pass
+        prodigal.wait()
+
+        if not os.path.isfile(training) or os.stat(training).st_size == 0:
+            raise SRUFinderError('Prodigal failed!')
+
+def run_shard(args):
+    '''
+    Run the workflow on one shard of a split input,
+    with the output in the shard directory of the split
+    '''
+
+    split_dir = os.path.join(args.split, '')
+    if not os.path.isfile(shard_fasta(split_dir, args.shard_id)):
+        raise SRUFinderError('Could not find shard {} in {}'.format(args.shard_id, split_dir))
+
+    args.input = shard_fasta(split_dir, args.shard_id)
+    args.output = shard_dir(split_dir, args.shard_id)
+    args.shard = True
+    if args.training is None and args.prodigal == 'single' and os.path.isfile(split_dir+'prodigal.trn'):
+        args.training = split_dir+'prodigal.trn'
+
+    done = shard_done(split_dir, args.shard_id)
+    if os.path.isfile(done):
+        os.remove(done)
+
+    workflow.run(args)
+
+    # Mark the shard as finished for the merge
+    open(done, 'w').close()
+
+class Merge(object):
+    '''
+    Merge the outputs of the shards of a split input,
+    with clusters numbered after those of the previous shards,
+    and with --selfmatch match the spacers of all shards against the whole input masked by arrays
+    '''
+
+    def __init__(self, args):
+
+        self.split = os.path.join(args.split, '')
+        if not os.path.isfile(self.split+'shards.tab'):
+            raise SRUFinderError('Could not find shards.tab in '+self.split)
+        self.shards = list(pd.read_csv(self.split+'shards.tab', sep='\t')['Shard'])
+
+        # All shards should have finished
+        missing = [str(i) for i in self.shards if not os.path.isfile(shard_done(self.split, i))]
+        if len(missing) > 0:
+            raise SRUFinderError('Shard(s) {} have not finished'.format(', '.join(missing)))
+
+        # The whole input masked by arrays is the input of the merge when self-matching.
+        # Otherwise no sequences are needed, and the first shard is the input
+        if args.selfmatch:
+            genome = self.split+'genome.fna'
+            if os.path.isfile(genome):
+                os.remove(genome)
+            for i in self.shards:
+                workflow.append_genome(genome, shard_dir(self.split, i), Fasta(shard_fasta(self.split, i)))
+            args.input = genome
+        else:
+            args.input = shard_fasta(self.split, self.shards[0])
+
+        self.master = Controller(args)
+
+    def run(self):
+        '''
+        Append the outputs of all shards and run the self-matching
+        '''
+
+        try:
+            if self.master.selfmatch:
+                os.replace(self.master.fasta, self.master.out+'genome.fna')
+                self.master.fasta = self.master.out+'genome.fna'
+                self.master.sequences = Fasta(self.master.fasta)
+
+            logging.info('Merging {} shards'.format(len(self.shards)))
+
+            offset = 0
+            for i in self.shards:
+                offset = workflow.append_batch(self.master.out, shard_dir(self.split, i), offset)
+
+            logging.info('Merged {} cluster(s)'.format(offset))
+
+            Blast(self.master).run_spacer()
+
+            self.master.clean()
+            logging.info('Done')
+        finally:
+            self.master.profiler.write()
@@ -0,0 +1,169 @@
+import os
+import copy
+import logging
+import argparse
+import itertools
+import multiprocessing
+
+import pandas as pd
+
+from srufinder.arguments import add_options
+from srufinder.controller import Controller
+from srufinder.cluster import Cluster
+from srufinder.prodigal import read_gff
+from srufinder.sequences import Fasta
+from srufinder.errors import SRUFinderError
+
+# Thresholds which only affect the clustering, and can be swept over cached hits
+SWEEP = ('identity', 'coverage', 'score', 'coverage_part', 'max_dist', 'flank')
+
+# Sweep object shared with forked worker processes
+_sweep = None
+
+def _run_setting(i):
+    '''
+    Cluster the hits with one setting of the grid in a worker process
+    '''
+
+    return _sweep.cluster(i)
+
+def read_arguments(run):
+    '''
+    Read the arguments of a previous run from its arguments.tab,
+    with the types and defaults of the command line options
+    '''
+
+    ap = argparse.ArgumentParser()
+    add_options(ap)
+    args = ap.parse_args([])
+
+    with open(run+'arguments.tab', 'r') as f:
+        for line in f:
+            k, v = line.rstrip('\n').split(': ', 1)
+            if isinstance(getattr(args, k, None), bool):
+                v = v == 'True'
+            elif hasattr(args, k):
+                v = getattr(ap.parse_args(['--'+k, v]), k)
+            setattr(args, k, v)
+
+    return args
+
+class Sweep(object):
+    '''
+    Cluster the hits of a previous run with each setting of a grid of thresholds,
+    without rerunning prodigal or the repeat search.
+    The hits are loaded once with the loosest identity and coverage, and shared with the worker processes
+    '''
+
+    def __init__(self, args):
+
+        logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=args.log_lvl)
+
+        self.run_dir = os.path.join(args.run, '')
+        self.threads = args.threads
+        self.write_all = args.write
+
+        if not os.path.isfile(self.run_dir+'arguments.tab') or not os.path.isfile(self.run_dir+'blast.tab'):
+            raise SRUFinderError('Could not find arguments.tab and blast.tab in '+self.run_dir)
+
+        # The previous run, with the sweep as output directory
+        run_args = read_arguments(self.run_dir)
+        if run_args.input == '-':
+            raise SRUFinderError('Runs on input from stdin can not be swept')
+        run_args.output = args.output
+        run_args.db = args.db if args.db != '' else run_args.db
+        run_args.threads = 1
+        run_args.log_lvl = args.log_lvl
+        run_args.resume = False
+        run_args.profile = False
+        run_args.cprofile = False
+        self.master = Controller(run_args)
+
+        # Grid of thresholds, defaulting to those of the previous run
+        values = [getattr(args, x) if getattr(args, x) is not None else [getattr(run_args, x)] for x in SWEEP]
+        self.grid = list(itertools.product(*values))
+
+    def run(self):
+        '''
+        Load the hits, cluster them with each setting in parallel, and write the summary
+        '''
+
+        self.load()
+
+        logging.info('Clustering {} hits with {} settings'.format(len(self.hits), len(self.grid)))
+
+        global _sweep
+        _sweep = self
+        n = min(self.threads, len(self.grid))
+        if n > 1:
+            with multiprocessing.get_context('fork').Pool(n) as pool:
+                rows = list(pool.imap(_run_setting, range(len(self.grid))))
+        else:
+            rows = [self.cluster(i) for i in range(len(self.grid))]
+        _sweep = None
+
+        summary = pd.DataFrame(rows)
+        summary.to_csv(self.master.out+'sweep.tab', index=False, sep='\t')
+
+        logging.info('Done')
+
+    def load(self):
+        '''
+        Load the hits of the previous run passing the loosest identity and coverage of the grid.
+        Hits of compacted databases are expanded once against the searched sequence,
+        and only intergenic hits are kept if the previous run split hits by ORFs
+        '''
+
+        cluster = Cluster(self.master)
+        self.master.identity = min(x[SWEEP.index('identity')] for x in self.grid)
+        self.master.coverage_part = min(x[SWEEP.index('coverage_part')] for x in self.grid)
+
+        if self.master.compact:
+            if self.master.orf_split:
+                cluster.searched = self.master.sequences
+            elif os.path.isfile(self.run_dir+'masked.fna'):
+                cluster.searched = Fasta(self.run_dir+'masked.fna')
+            else:
+                raise SRUFinderError('Could not find masked.fna in '+self.run_dir+'. Run with --resume to keep it')
+
+        logging.info('Loading hits of '+self.run_dir)
+        cluster.load_hits(self.run_dir+'blast.tab')
+
+        if self.master.orf_split:
+            if not os.path.isfile(self.run_dir+'prodigal.gff'):
+                raise SRUFinderError('Could not find prodigal.gff in '+self.run_dir+'. Run with --resume to keep it')
+            with open(self.run_dir+'prodigal.gff', 'r') as handle:
+                self.master.genes, _ = read_gff(handle, self.master.orf)
+            hits = cluster.classify(cluster.df)
+            cluster.df = hits[~hits['Overlap']].drop(columns=['Overlap', 'Inside', 'ORF_start', 'ORF_end'])
+
+        self.hits = cluster.df
+
+    def cluster(self, i):
+        '''
+        Cluster the hits with one setting, optionally write its output files,
+        and return a summary of the setting
+        '''
+
+        setting = dict(zip(SWEEP, self.grid[i]))
+
+        master = copy.copy(self.master)
+        for k, v in setting.items():
+            setattr(master, k, v)
+
+        cluster = Cluster(master)
+        cluster.df = self.hits[(self.hits['Identity'] >= master.identity) & (self.hits['Coverage'] >= master.coverage_part)].copy()
+        cluster.df['Acc'] = cluster.df['Acc'].cat.remove_unused_categories()
+        cluster.cluster_hits()
+
+        if self.write_all:
+            master.out = self.master.out+'setting_{}/'.format(i+1)
+            os.makedirs(master.out, exist_ok=True)
+            cluster.write(genome=False)
+
+        return dict(Setting=i+1, **setting,
+                    Hits=len(cluster.df),
+                    Hits_no_overlap=0 if cluster.df_overlap is None else len(cluster.df_overlap),
+                    SRUs=len(cluster.df_sru),
+                    Arrays=len(cluster.df_arrays),
+                    Spacers=len(cluster.df_spacers))
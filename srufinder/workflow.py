@@ -0,0 +1,183 @@
+import os
+import logging
+import copy
+import shutil
+
+import pandas as pd
+
+from srufinder.controller import Controller
+from srufinder.prodigal import Prodigal
+from srufinder.blast import Blast
+from srufinder.cluster import Cluster
+from srufinder.sequences import Genome, write_fasta
+
+def run(args, len_df=None):
+    '''
+    Run the full workflow on a single input fasta
+    '''
+
+    master = Controller(args, len_df)
+
+    # Write the resource use also if the run stops early
+    try:
+        if master.stream_mb > 0:
+            stream(master)
+            return
+
+        proteins = Prodigal(master)
+        proteins.run()
+
+        blast = Blast(master)
+        blast.run()
+
+        cluster = Cluster(master)
+        cluster.run()
+
+        # Shards are self-matched when merged
+        if not master.shard:
+            blast.run_spacer()
+
+        master.clean()
+        logging.info('Done')
+    finally:
+        master.profiler.write()
+
+def batches(master, size):
+    '''
+    Split the contigs in input order in batches of at most size bp,
+    each kept in memory. Contigs longer than size are a batch on their own
+    '''
+
+    batch = []
+    bp = 0
+    for name, header, seq in master.records():
+        if len(batch) > 0 and bp + len(seq) > size:
+            yield Genome(batch)
+            batch = []
+            bp = 0
+        batch.append((header, seq))
+        bp += len(seq)
+
+    if len(batch) > 0:
+        yield Genome(batch)
+
+def stream(master):
+    '''
+    Run the workflow on batches of contigs, one batch at a time,
+    and append the results of each batch to the output files.
+    Only one batch is held in memory at a time, and fed to prodigal through a pipe.
+    Compressed input is decompressed again for each pass over the input,
+    and input from stdin is first kept compressed in the output directory
+    '''
+
+    sub_dir = master.out+'stream/'
+
+    spooled = master.sequences is None and master.fasta == '-'
+    if spooled:
+        master.spool()
+
+    # Train prodigal once on all contigs such that all batches use the same model, unless a model is given
+    trained = master.prod == 'single' and master.training is None
+    if trained:
+        master.training = Prodigal(master).train(master.out+'prodigal.trn')
+
+    for name in ('SRUs.tab', 'arrays.tab', 'blast_best.tab', 'spacers.fa', 'genome.fna',
+                 'SRUs_in_orf.tab', 'arrays_in_orf.tab', 'blast_best_in_orf.tab', 'spacers_in_orf.fa'):
+        if os.path.isfile(master.out+name):
+            os.remove(master.out+name)
+
+    offset = 0
+    n_batch = 0
+    for i, batch in enumerate(batches(master, int(master.stream_mb*1e6))):
+        n_batch += 1
+        logging.info('Streaming batch {} with {} contig(s)'.format(i+1, len(batch)))
+
+        if os.path.isdir(sub_dir):
+            shutil.rmtree(sub_dir)
+        os.mkdir(sub_dir)
+
+        sub = copy.copy(master)
+        sub.out = sub_dir
+        sub.sequences = batch
+        sub.plain = False
+        sub.resume = False
+        sub.checkpoints = {}
+        sub.file_hashes = {}
+
+        Prodigal(sub).run()
+        Blast(sub).run()
+        Cluster(sub).run()
+
+        offset = append_batch(master.out, sub_dir, offset)
+        if master.selfmatch or master.shard:
+            append_genome(master.out+'genome.fna', sub_dir, batch)
+        del sub
+
+    shutil.rmtree(sub_dir)
+    if trained:
+        os.remove(master.training)
+        master.training = None
+    if spooled:
+        os.remove(master.source)
+
+    logging.info('Streamed {} batch(es)'.format(n_batch))
+
+    if not master.shard:
+        Blast(master).run_spacer()
+
+    master.clean()
+    logging.info('Done')
+
+def append_batch(out, sub_dir, offset):
+    '''
+    Append the output of a batch to the output files in the out directory,
+    with the clusters numbered after those of the previous batches.
+    Return the cluster offset for the next batch
+    '''
+
+    n_cluster = 0
+    for suffix in ('', '_in_orf'):
+        for name in ('SRUs{}.tab', 'arrays{}.tab'):
+            name = name.format(suffix)
+            if os.path.isfile(sub_dir+name):
+                # Read as text such that all other columns are written back unchanged
+                df = pd.read_csv(sub_dir+name, sep='\t', dtype=str, keep_default_na=False)
+                cluster = df['Cluster'].astype(int)
+                n_cluster = max(n_cluster, cluster.max() + 1)
+                df['Cluster'] = cluster + offset
+                df.to_csv(out+name, index=False, sep='\t', mode='a', header=not os.path.isfile(out+name))
+
+        name = 'blast_best{}.tab'.format(suffix)
+        if os.path.isfile(sub_dir+name):
+            with open(sub_dir+name, 'r') as in_file, open(out+name, 'a') as out_file:
+                header = in_file.readline()
+                if out_file.tell() == 0:
+                    out_file.write(header)
+                shutil.copyfileobj(in_file, out_file)
+
+        name = 'spacers{}.fa'.format(suffix)
+        if os.path.isfile(sub_dir+name):
+            with open(sub_dir+name, 'r') as in_file, open(out+name, 'a') as out_file:
+                for line in in_file:
+                    if line.startswith('>'):
+                        header, n = line[1:].rstrip('\n').rsplit(':', 1)
+                        acc, cl = header.rsplit('_', 1)
+                        line = '>{}_{}:{}\n'.format(acc, int(cl) + offset, n)
+                    out_file.write(line)
+
+    return offset + n_cluster
+
+def append_genome(path, sub_dir, sequences):
+    '''
+    Append the input of a batch masked by arrays to a fasta.
+    The masked input of batches without arrays is the input itself
+    '''
+
+    if os.path.isfile(sub_dir+'genome.fna'):
+        with open(sub_dir+'genome.fna', 'r') as in_file, open(path, 'a') as out_file:
+            shutil.copyfileobj(in_file, out_file)
+        return
+
+    with open(path, 'a') as out_file:
+        for name, header, seq in sequences.records():
+            write_fasta(out_file, header, seq)